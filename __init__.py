@@ -28,5 +28,9 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 def classFactory(iface):
+    from timings import clock, recordSince
+    start = clock()
     from autoTrace import AutoTrace
-    return AutoTrace(iface)
+    plugin = AutoTrace(iface)
+    recordSince("startup: import", start)
+    return plugin
@@ -27,16 +27,21 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import os
+
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 from qgis.core import *
 from qgis.gui import *
 
-# initialize Qt resources from file resources.py
-import resources
+# The tool and the tracing modules are only imported when the tool is first used
+from timings import clock, recordSince, timings, timed
+from geometryValidation import ValidationTask, estimatedVertexCount, FULL_VALIDATION, QUICK_VALIDATION, SKIP_VALIDATION
 
-#Import own tools
-from vertexTracerTool import VertexTracerTool
+# What became of a traced feature, see AutoTrace.traceOutcome()
+TRACE_ADDED = "added"           # in the layer's edit buffer, undo removes it
+TRACE_PENDING = "pending"       # waiting to be added with a rapid trace batch
+TRACE_DISCARDED = "discarded"   # the feature form was cancelled
 
 # Our main class for the plugin
 class AutoTrace:
@@ -47,19 +52,71 @@ class AutoTrace:
         self.canvas = self.iface.mapCanvas()
     
     def initGui(self):
+        start = clock()
         mc = self.canvas
         layer = mc.currentLayer()
         
         self.rubberBand = 0
+        self.tool = None
         
         # Create an action for getting help
-        self.helpAction = QAction(QIcon(":/plugins/autoTrace/iconAutoTrace.png"), "Help", self.iface.mainWindow())
+        icon = QIcon(os.path.join(os.path.dirname(__file__), "iconAutoTrace.png"))
+        self.helpAction = QAction(icon, "Help", self.iface.mainWindow())
         QObject.connect(self.helpAction, SIGNAL("triggered()"), self.openHelp)
-        self.menu = self.iface.pluginMenu().addMenu(QIcon(":/plugins/autoTrace/iconAutoTrace.png"), "AutoTrace")
+        self.menu = self.iface.pluginMenu().addMenu(icon, "AutoTrace")
         self.menu.addAction(self.helpAction)
+        
+        # Create an action for choosing between the shortest route by length or by number of vertices
+        self.routeByLengthAction = QAction("Shortest route by length", self.iface.mainWindow())
+        self.routeByLengthAction.setCheckable(True)
+        self.routeByLengthAction.setChecked(QSettings().value("/autoTrace/routeByLength", False, type=bool))
+        QObject.connect(self.routeByLengthAction, SIGNAL("toggled(bool)"), self.setRouteByLength)
+        self.menu.addAction(self.routeByLengthAction)
+        
+        # Rapid trace: no attribute form, traced features are added in batches
+        self.rapidTraceAction = QAction("Rapid trace (no attribute form)", self.iface.mainWindow())
+        self.rapidTraceAction.setCheckable(True)
+        self.rapidTraceAction.setChecked(QSettings().value("/autoTrace/rapidTrace", False, type=bool))
+        QObject.connect(self.rapidTraceAction, SIGNAL("toggled(bool)"), self.setRapidTrace)
+        self.menu.addAction(self.rapidTraceAction)
+        self.pendingLayer = None
+        self.pendingFeatures = []
+        self.pendingRb = None
+        
+        # Actions for recording where the time goes while tracing
+        self.recordTimingsAction = QAction("Record timings", self.iface.mainWindow())
+        self.recordTimingsAction.setCheckable(True)
+        self.recordTimingsAction.setChecked(QSettings().value("/autoTrace/recordTimings", False, type=bool))
+        timings.enabled = self.recordTimingsAction.isChecked()
+        QObject.connect(self.recordTimingsAction, SIGNAL("toggled(bool)"), self.setRecordTimings)
+        self.showTimingsAction = QAction("Show timings", self.iface.mainWindow())
+        QObject.connect(self.showTimingsAction, SIGNAL("triggered()"), self.showTimings)
+        self.exportTimingsAction = QAction("Export timings...", self.iface.mainWindow())
+        QObject.connect(self.exportTimingsAction, SIGNAL("triggered()"), self.exportTimings)
+        self.timingsMenu = self.menu.addMenu("Timings")
+        self.timingsMenu.addAction(self.recordTimingsAction)
+        self.timingsMenu.addAction(self.showTimingsAction)
+        self.timingsMenu.addAction(self.exportTimingsAction)
+        
+        # Actions for choosing how big traces are validated
+        self.validationMenu = self.menu.addMenu("Validation of large traces")
+        self.validationGroup = QActionGroup(self.iface.mainWindow())
+        validation = QSettings().value("/autoTrace/largeGeometryValidation", FULL_VALIDATION)
+        for mode, text in [(FULL_VALIDATION, "Full"),
+                           (QUICK_VALIDATION, "Quick (GEOS only, no error locations)"),
+                           (SKIP_VALIDATION, "Skip")]:
+            action = QAction(text, self.iface.mainWindow())
+            action.setCheckable(True)
+            action.setChecked(mode == validation)
+            action.setData(mode)
+            self.validationGroup.addAction(action)
+            self.validationMenu.addAction(action)
+        QObject.connect(self.validationGroup, SIGNAL("triggered(QAction*)"), self.setLargeGeometryValidation)
+        self.validationTasks = []
+        self.validationMarkers = []
           
         # Create action that will start plugin configuration
-        self.action = QAction(QIcon(":/plugins/autoTrace/iconAutoTrace.png"), "Auto-trace", self.iface.mainWindow())
+        self.action = QAction(icon, "Auto-trace", self.iface.mainWindow())
         self.action.setEnabled(False)
         self.action.setCheckable(True)
         self.action.setChecked(False)
@@ -71,20 +128,121 @@ class AutoTrace:
         
         # Add toolbar button 
         self.iface.digitizeToolBar().addAction(self.action)
-
-        #Get the Tool
+        
+        self.traceIndexMessage = None
+        
+        # Offer batch tracing in the Processing toolbox if it is installed
+        self.processingProvider = None
+        try:
+            from processing.core.Processing import Processing
+            from autoTraceProvider import AutoTraceProvider
+            self.processingProvider = AutoTraceProvider()
+            Processing.addProvider(self.processingProvider, updateList=False)
+        except ImportError:
+            pass
+        
+        recordSince("startup: initGui", start)
+    
+    def createTool(self):
+        """ Create the map tool, the first time it is used. """
+        start = clock()
+        from vertexTracerTool import VertexTracerTool
         self.tool = VertexTracerTool(self.canvas)
+        
+        # Show progress while the tool prepares the snappable layers in the background
+        manager = self.tool.traceIndexManager
+        QObject.connect(manager, SIGNAL("progress(int)"), self.traceIndexProgress)
+        QObject.connect(manager, SIGNAL("ready()"), self.clearTraceIndexMessage)
+        QObject.connect(manager, SIGNAL("cancelled()"), self.clearTraceIndexMessage)
+        recordSince("startup: tool", start)
     
     def unload(self):
+        self.flushPendingFeatures()
+        if self.pendingRb is not None:
+            self.canvas.scene().removeItem(self.pendingRb)
+        self.clearTraceIndexMessage()
+        QObject.disconnect(self.iface, SIGNAL("currentLayerChanged(QgsMapLayer*)"), self.toggle)
+        QObject.disconnect(self.canvas, SIGNAL("mapToolSet(QgsMapTool*)"), self.deactivate)
+        if self.tool is not None:
+            if self.canvas.mapTool() == self.tool:
+                self.canvas.unsetMapTool(self.tool)
+            QObject.disconnect(self.tool, SIGNAL("traceFound(PyQt_PyObject)"), self.createFeature)
+            # Qt aborts if a thread that is still running is garbage collected
+            self.tool.shutdown()
+            manager = self.tool.traceIndexManager
+            QObject.disconnect(manager, SIGNAL("progress(int)"), self.traceIndexProgress)
+            QObject.disconnect(manager, SIGNAL("ready()"), self.clearTraceIndexMessage)
+            QObject.disconnect(manager, SIGNAL("cancelled()"), self.clearTraceIndexMessage)
+            # The tool is parented to the canvas, which outlives the plugin
+            manager.deleteLater()
+            self.tool.deleteLater()
+            self.tool = None
+        for task in self.validationTasks:
+            task.wait()
+        self.clearValidationMarkers()
         self.iface.digitizeToolBar().removeAction(self.action)
         self.menu.removeAction(self.helpAction)
         self.iface.pluginMenu().removeAction(self.menu.menuAction())
+        if self.processingProvider is not None:
+            from processing.core.Processing import Processing
+            Processing.removeProvider(self.processingProvider)
     
     def openHelp(self):
         # Open the help page
         QDesktopServices.openUrl(QUrl('http://www.lutraconsulting.co.uk/resources/autotrace'))
     
+    def setRouteByLength(self, enabled):
+        QSettings().setValue("/autoTrace/routeByLength", enabled)
+        if self.tool is not None:
+            self.tool.routeByLength = enabled
+    
+    def setRapidTrace(self, enabled):
+        QSettings().setValue("/autoTrace/rapidTrace", enabled)
+        if not enabled:
+            self.flushPendingFeatures()
+    
+    def setRecordTimings(self, enabled):
+        QSettings().setValue("/autoTrace/recordTimings", enabled)
+        timings.enabled = enabled
+    
+    def showTimings(self):
+        QgsMessageLog.logMessage(timings.summaryText(), "AutoTrace")
+        self.iface.messageBar().pushMessage("AutoTrace", "Timings written to the AutoTrace tab of the log messages panel", level=QgsMessageBar.INFO)
+    
+    def setLargeGeometryValidation(self, action):
+        QSettings().setValue("/autoTrace/largeGeometryValidation", action.data())
+    
+    def exportTimings(self):
+        fileName = QFileDialog.getSaveFileName(self.iface.mainWindow(), "Export timings", "autotrace_timings.json", "JSON (*.json)")
+        if not fileName:
+            return
+        with open(fileName, "w") as f:
+            f.write(timings.toJson())
+    
+    def traceIndexProgress(self, percent):
+        if self.traceIndexMessage is None:
+            self.traceIndexMessage = self.iface.messageBar().createMessage("AutoTrace", "Preparing snappable layers for tracing...")
+            self.traceIndexProgressBar = QProgressBar()
+            self.traceIndexProgressBar.setMaximum(100)
+            cancelButton = QPushButton("Cancel")
+            QObject.connect(cancelButton, SIGNAL("clicked()"), self.tool.traceIndexManager.cancel)
+            self.traceIndexMessage.layout().addWidget(self.traceIndexProgressBar)
+            self.traceIndexMessage.layout().addWidget(cancelButton)
+            self.iface.messageBar().pushWidget(self.traceIndexMessage, QgsMessageBar.INFO)
+        self.traceIndexProgressBar.setValue(percent)
+    
+    def clearTraceIndexMessage(self):
+        if self.traceIndexMessage is not None:
+            try:
+                self.iface.messageBar().popWidget(self.traceIndexMessage)
+            except RuntimeError:
+                pass  # Already closed by the user
+            self.traceIndexMessage = None
+    
     def toggle(self):
+        # Features traced into the previous layer go there before anything else
+        self.flushPendingFeatures()
+        
         mc = self.canvas
         layer = mc.currentLayer()
         
@@ -103,12 +261,17 @@ class AutoTrace:
     def deactivate(self):
         #uncheck the button/menu and get rid off the VTTool signal
         self.action.setChecked(False)
-        QObject.disconnect(self.tool, SIGNAL("traceFound(PyQt_PyObject)"), self.createFeature)
+        if self.tool is not None:
+            QObject.disconnect(self.tool, SIGNAL("traceFound(PyQt_PyObject)"), self.createFeature)
+        self.clearValidationMarkers()
+        self.flushPendingFeatures()
     
     def run(self):
         #Here we go...
         mc = self.canvas
         layer = mc.currentLayer()
+        if self.tool is None:
+            self.createTool()
       
         #bring our tool into action
         mc.setMapTool(self.tool)
@@ -122,6 +285,116 @@ class AutoTrace:
             self.iface.messageBar().pushMessage("AutoTrace", \
             "None of the enabled layers have snapping enabled - AutoTrace needs snappable layers in order to trace.", level=QgsMessageBar.WARNING)
             
+    def addPendingFeature(self, layer, f):
+        """ Keep a feature traced in rapid trace mode until the batch is
+        added to the layer. Pending features are shown in a rubber band. """
+        if self.pendingLayer is not None and self.pendingLayer.id() != layer.id():
+            self.flushPendingFeatures()
+        if self.pendingRb is None:
+            self.pendingRb = QgsRubberBand(self.canvas, QGis.Line)
+        if self.pendingLayer is None:
+            self.pendingLayer = layer
+            self.pendingRb.reset(layer.geometryType())
+            self.pendingRb.setColor(QColor(0, 0, 255, 100))
+            # Make sure the batch is in the layer before its edits are saved
+            QObject.connect(layer, SIGNAL("beforeCommitChanges()"), self.flushPendingFeatures)
+        self.pendingFeatures.append(f)
+        self.pendingRb.addGeometry(f.geometry(), layer)
+    
+    def flushPendingFeatures(self):
+        """ Add the features traced in rapid trace mode to their layer in
+        one edit command. """
+        layer = self.pendingLayer
+        features = self.pendingFeatures
+        self.pendingLayer = None
+        self.pendingFeatures = []
+        if layer is None:
+            return
+        self.pendingRb.reset(QGis.Line)
+        
+        try:
+            QObject.disconnect(layer, SIGNAL("beforeCommitChanges()"), self.flushPendingFeatures)
+            editable = layer.isEditable()
+        except RuntimeError:
+            editable = False  # The layer has been removed
+        if not editable:
+            self.iface.messageBar().pushMessage("AutoTrace", \
+                "%d traced feature(s) could not be added, the layer is not being edited any more." % len(features), level=QgsMessageBar.WARNING)
+            return
+        
+        layer.beginEditCommand("%d traced features added" % len(features))
+        if layer.addFeatures(features, False):
+            layer.endEditCommand()
+        else:
+            layer.destroyEditCommand()
+        layer.triggerRepaint()
+    
+    def validateFeature(self, layer, geom):
+        """ Start validating the geometry of a new feature and return the
+        task, or None if the geometry is not validated. Problems are
+        reported once both the task has finished and traceOutcome() has
+        been told what became of the feature. """
+        locateErrors = True
+        s = QSettings()
+        if estimatedVertexCount(geom) > s.value("/autoTrace/largeGeometryVertices", 50000, type=int):
+            validation = s.value("/autoTrace/largeGeometryValidation", FULL_VALIDATION)
+            if validation == SKIP_VALIDATION:
+                return None
+            locateErrors = validation != QUICK_VALIDATION
+        task = ValidationTask(geom, locateErrors)
+        task.outcome = None
+        task.done = False
+        QObject.connect(task, SIGNAL("finished()"), lambda task=task, layer=layer: self.validationFinished(task, layer))
+        self.validationTasks.append(task)
+        task.start(QThread.LowPriority)
+        return task
+    
+    def traceOutcome(self, task, layer, outcome):
+        """ Note what became of a feature being validated (one of the
+        TRACE_ constants). The feature form may still have been open when
+        validation finished. """
+        if task is None:
+            return
+        task.outcome = outcome
+        if task.done:
+            self.reportValidation(task, layer)
+    
+    def validationFinished(self, task, layer):
+        self.validationTasks.remove(task)
+        task.done = True
+        if task.outcome is not None:
+            self.reportValidation(task, layer)
+    
+    def reportValidation(self, task, layer):
+        # Nothing to report about a feature that was never added
+        if len(task.errors) == 0 or task.outcome == TRACE_DISCARDED:
+            return
+        
+        # Mark where the problems are and say what they are without getting in the way
+        from geometryCache import layerToMapTransform
+        transform = layerToMapTransform(self.canvas.mapRenderer(), layer)
+        for message, where in task.errors:
+            QgsMessageLog.logMessage("Traced feature is not valid: %s%s" % (message, "" if where is None else " at [%f, %f]" % (where.x(), where.y())), "AutoTrace")
+            if where is None:
+                continue
+            if transform is not None:
+                where = transform.transform(where)
+            marker = QgsVertexMarker(self.canvas)
+            marker.setCenter(where)
+            marker.setIconType(QgsVertexMarker.ICON_X)
+            marker.setColor(QColor(255, 0, 0))
+            marker.setPenWidth(2)
+            self.validationMarkers.append(marker)
+        message = "The traced feature is not valid: %s (%d problem(s), see the log messages panel)." % (task.errors[0][0], len(task.errors))
+        if task.outcome == TRACE_ADDED:
+            message += " Undo to remove it."
+        self.iface.messageBar().pushMessage("AutoTrace", message, level=QgsMessageBar.WARNING, duration=10)
+    
+    def clearValidationMarkers(self):
+        for marker in self.validationMarkers:
+            self.canvas.scene().removeItem(marker)
+        self.validationMarkers = []
+    
     def snappableLayerCount(self):
         count = 0
         proj = QgsProject.instance()
@@ -130,6 +403,7 @@ class AutoTrace:
                 count += 1
         return count
  
+    @timed("createFeature")
     def createFeature(self, geom):
 
         if not geom:
@@ -139,36 +413,28 @@ class AutoTrace:
         provider = layer.dataProvider()
         fields = provider.fields()
         f = QgsFeature(fields)
+        f.setGeometry(geom)
         
-        errors = geom.validateGeometry()
-        if len(errors) == 0:
-            f.setGeometry(geom)
-        else:
-            # Concatenate errors into a string
-            errorsString = ""
-            for error in errors:
-                locationString = "[" + str(error.where().x()) + "," + str(error.where().y()) + "]"
-                errorsString += error.what()
-                errorsString += "\n  "
-                errorsString += locationString
-                errorsString += "\n"
-            reply = QMessageBox.question(self.iface.mainWindow(), 'Feature not valid',
-            "The geometry of the feature you just added isn't valid. Do you want to use it anyway?\n\n" + 
-            "Errors were:\n\n" +
-            errorsString,
-            QMessageBox.Yes, QMessageBox.No)
-            if reply == QMessageBox.Yes:
-                f.setGeometry(geom)
-            else:
-                return False
+        # Validate in the background while the feature form is open
+        self.clearValidationMarkers()
+        task = self.validateFeature(layer, geom)
+        
+        if self.rapidTraceAction.isChecked():
+            for i in range(fields.count()):
+                f.setAttribute(i, provider.defaultValue(i))
+            self.addPendingFeature(layer, f)
+            self.traceOutcome(task, layer, TRACE_PENDING)
+            return True
 
         # this is the preferred way of adding features in QGIS >= 2.4
         # it respects default values, suppression of attribute form, reuse of recent values etc.
         if QGis.QGIS_VERSION_INT >= 20400:
             if self.iface.vectorLayerTools().addFeature(layer, {}, geom):
-                self.canvas.refresh()
+                self.traceOutcome(task, layer, TRACE_ADDED)
+                layer.triggerRepaint()
                 return True
             else:
+                self.traceOutcome(task, layer, TRACE_DISCARDED)
                 return False
 
         # compatibility code for older versions: QGIS < 2.4
@@ -178,10 +444,12 @@ class AutoTrace:
         # let the user set some attributes
         if not self.iface.openFeatureForm(layer, f):
             layer.destroyEditCommand()
+            self.traceOutcome(task, layer, TRACE_DISCARDED)
             return False
 
         layer.endEditCommand()
+        self.traceOutcome(task, layer, TRACE_ADDED)
         
-        self.canvas.refresh()
+        layer.triggerRepaint()
 
 
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+    Processing provider with the batch tracing algorithm.
+
+    Only imported when the Processing plugin is available.
+"""
+
+import os
+
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+from qgis.core import *
+
+from processing.core.AlgorithmProvider import AlgorithmProvider
+from processing.core.GeoAlgorithm import GeoAlgorithm
+from processing.core.GeoAlgorithmExecutionException import GeoAlgorithmExecutionException
+from processing.core.parameters import ParameterVector, ParameterTableField, ParameterMultipleInput, \
+    ParameterNumber, ParameterBoolean, ParameterSelection
+from processing.core.outputs import OutputVector
+from processing.tools import dataobjects, vector
+
+
+def pluginIcon():
+    return QIcon(os.path.join(os.path.dirname(__file__), "iconAutoTrace.png"))
+
+
+class TraceWaypointsAlgorithm(GeoAlgorithm):
+    """
+        Traces a line or polygon through each group of waypoints along the
+        boundaries of the reference layers. Waypoints are grouped by the
+        trace field (all of them make one trace if it is not set) and
+        visited in the order of the order field (or feature id), so a pair
+        of points gives a trace between them.
+    """
+
+    WAYPOINTS = "WAYPOINTS"
+    TRACE_FIELD = "TRACE_FIELD"
+    ORDER_FIELD = "ORDER_FIELD"
+    REFERENCE_LAYERS = "REFERENCE_LAYERS"
+    TOLERANCE = "TOLERANCE"
+    BY_LENGTH = "BY_LENGTH"
+    GEOMETRY_TYPE = "GEOMETRY_TYPE"
+    OUTPUT = "OUTPUT"
+
+    GEOMETRY_TYPES = ["Line", "Polygon"]
+
+    def defineCharacteristics(self):
+        self.name = "Trace waypoints"
+        self.group = "Tracing"
+        self.addParameter(ParameterVector(self.WAYPOINTS, "Waypoints", [ParameterVector.VECTOR_TYPE_POINT]))
+        self.addParameter(ParameterTableField(self.TRACE_FIELD, "Trace id field", self.WAYPOINTS, optional=True))
+        self.addParameter(ParameterTableField(self.ORDER_FIELD, "Order field", self.WAYPOINTS, optional=True))
+        self.addParameter(ParameterMultipleInput(self.REFERENCE_LAYERS, "Layers to trace", ParameterMultipleInput.TYPE_VECTOR_ANY))
+        self.addParameter(ParameterNumber(self.TOLERANCE, "Snapping tolerance (waypoint layer units)", 0.0, 999999999.0, 1.0))
+        self.addParameter(ParameterBoolean(self.BY_LENGTH, "Shortest route by length", False))
+        self.addParameter(ParameterSelection(self.GEOMETRY_TYPE, "Output geometry", self.GEOMETRY_TYPES, 0))
+        self.addOutput(OutputVector(self.OUTPUT, "Traces"))
+
+    def getIcon(self):
+        return pluginIcon()
+
+    def processAlgorithm(self, progress):
+        waypointLayer = dataobjects.getObjectFromUri(self.getParameterValue(self.WAYPOINTS))
+        traceField = self.getParameterValue(self.TRACE_FIELD)
+        orderField = self.getParameterValue(self.ORDER_FIELD)
+        polygons = self.getParameterValue(self.GEOMETRY_TYPE) == 1
+        crs = waypointLayer.crs()
+        if self.getParameterValue(self.TOLERANCE) <= 0:
+            raise GeoAlgorithmExecutionException("The snapping tolerance must be greater than zero")
+
+        # Imported here to keep the tracing modules out of QGIS startup
+        from batchTrace import BatchTracer
+        tracer = BatchTracer(self.getParameterValue(self.TOLERANCE),
+                             self.getParameterValue(self.BY_LENGTH),
+                             QSettings().value("/autoTrace/graphTolerance", 0.0, type=float))
+        uris = self.getParameterValue(self.REFERENCE_LAYERS).split(";")
+        for uriNr, uri in enumerate(uris):
+            progress.setText("Indexing %s" % uri)
+            tracer.addLayer(dataobjects.getObjectFromUri(uri), crs)
+            progress.setPercentage(int(50 * (uriNr + 1) / len(uris)))
+
+        traces = self.waypointGroups(waypointLayer, traceField, orderField)
+        if len(traces) == 0:
+            raise GeoAlgorithmExecutionException("There are no waypoints to trace")
+
+        fields = [QgsField("trace", QVariant.String),
+                  QgsField("waypoints", QVariant.Int),
+                  QgsField("snapped", QVariant.Int)]
+        geometryType = QGis.WKBPolygon if polygons else QGis.WKBLineString
+        writer = self.getOutputFromName(self.OUTPUT).getVectorWriter(fields, geometryType, crs)
+
+        # Each trace is written as soon as it is worked out
+        progress.setText("Tracing")
+        for traceNr, (traceId, waypoints) in enumerate(traces):
+            coords, snapped = tracer.trace(waypoints)
+            points = [QgsPoint(x, y) for x, y in coords]
+            if polygons:
+                if len(points) > 0 and points[0] != points[-1]:
+                    points.append(points[0])
+                if len(points) < 4:
+                    continue
+                geom = QgsGeometry.fromPolygon([points])
+            else:
+                if len(points) < 2:
+                    continue
+                geom = QgsGeometry.fromPolyline(points)
+            traceName = None    # NULL
+            if traceId is not None and traceId != NULL:
+                traceName = unicode(traceId)
+            f = QgsFeature()
+            f.setGeometry(geom)
+            f.setAttributes([traceName, len(waypoints), snapped])
+            writer.addFeature(f)
+            progress.setPercentage(50 + int(50 * (traceNr + 1) / len(traces)))
+        del writer
+
+    def waypointGroups(self, layer, traceField, orderField):
+        """ Return [(trace id, [(x, y)])] of the (selected) waypoints. The
+        points of a multipoint feature are visited in turn. """
+        traceIndex = layer.fieldNameIndex(traceField) if traceField else -1
+        orderIndex = layer.fieldNameIndex(orderField) if orderField else -1
+        groups = {}
+        for f in vector.features(layer):
+            if f.geometry() is None:
+                continue
+            if f.geometry().isMultipart():
+                points = f.geometry().asMultiPoint()
+            else:
+                points = [f.geometry().asPoint()]
+            traceId = f.attributes()[traceIndex] if traceIndex >= 0 else None
+            order = f.attributes()[orderIndex] if orderIndex >= 0 else f.id()
+            for pointNr, point in enumerate(points):
+                groups.setdefault(traceId, []).append((order, f.id(), pointNr, (point.x(), point.y())))
+        traces = []
+        for traceId in sorted(groups):
+            waypoints = sorted(groups[traceId])
+            traces.append((traceId, [point for order, fid, pointNr, point in waypoints]))
+        return traces
+
+
+class AutoTraceProvider(AlgorithmProvider):
+
+    def __init__(self):
+        AlgorithmProvider.__init__(self)
+        self.alglist = [TraceWaypointsAlgorithm()]
+        for alg in self.alglist:
+            alg.provider = self
+
+    def getName(self):
+        return "autotrace"
+
+    def getDescription(self):
+        return "AutoTrace"
+
+    def getIcon(self):
+        return pluginIcon()
+
+    def _loadAlgorithms(self):
+        self.algs = self.alglist
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+    Tracing many features at once, without the map tool.
+
+    A BatchTracer is given the reference layers up front. Each trace is an
+    ordered list of waypoints; every waypoint is snapped to the nearest
+    reference vertex and consecutive waypoints are joined the way the map
+    tool joins its clicks with shift held: along the ring both lie on if
+    they are on the same ring of the same feature, otherwise along the
+    trace graph, otherwise by a straight line.
+"""
+
+from PyQt4.QtCore import *
+from qgis.core import *
+
+from geometryCache import CachedGeometry
+from traceIndex import TraceIndex
+
+
+class BatchTracer:
+
+    def __init__(self, tolerance, byLength=False, graphTolerance=0.0, maxVisits=200000):
+        self.tolerance = tolerance
+        self.byLength = byLength
+        self.maxVisits = maxVisits
+        self.index = TraceIndex(graphTolerance)
+        self.geometries = {}    # (layer id, feature id) -> CachedGeometry
+
+    def addLayer(self, layer, crs, features=None):
+        """ Add the features of a reference layer (all of them unless
+        features is given), transformed to crs. """
+        self.index.addLayer(layer.id(), self.tolerance, True, layer.geometryType() != QGis.Point)
+        transform = None
+        if layer.crs().authid() != crs.authid():
+            transform = QgsCoordinateTransform(layer.crs(), crs)
+        if features is None:
+            features = layer.getFeatures(QgsFeatureRequest().setSubsetOfAttributes([]))
+        for f in features:
+            if f.geometry() is None:
+                continue
+            geom = QgsGeometry(f.geometry())
+            if transform is not None:
+                geom.transform(transform)
+            self.index.addFeature(layer.id(), f.id(), geom)
+            self.geometries[(layer.id(), f.id())] = CachedGeometry(geom)
+
+    def snap(self, x, y):
+        """ Return (distance, layer id, feature id, vertex nr, x, y) of the
+        nearest reference vertex or None. """
+        hits = self.index.nearestVertex(x, y)
+        if len(hits) == 0:
+            return None
+        return hits[0]
+
+    def trace(self, waypoints):
+        """
+            Return the traced (x, y) coordinates through waypoints, a list
+            of (x, y) tuples, and the number of waypoints that snapped.
+        """
+        snaps = [self.snap(x, y) for x, y in waypoints]
+        coords = []
+        for i, waypoint in enumerate(waypoints):
+            if i > 0:
+                coords.extend(self.route(snaps[i-1], snaps[i]))
+            if snaps[i] is not None:
+                coords.append((snaps[i][4], snaps[i][5]))
+            else:
+                coords.append(waypoint)
+
+        # Drop repeated vertices
+        deduped = []
+        for coord in coords:
+            if len(deduped) == 0 or deduped[-1] != coord:
+                deduped.append(coord)
+        return deduped, len([s for s in snaps if s is not None])
+
+    def route(self, first, second):
+        """ Return the coordinates between two snapped waypoints, excluding
+        the waypoints themselves. """
+        if first is None or second is None:
+            return []
+        if first[1:3] == second[1:3]:
+            coords = self.ringRoute(first[1:3], first[3], second[3])
+            if coords is not None:
+                return coords
+
+        graph = self.index.graph
+        start = graph.nodeAt(first[4], first[5])
+        end = graph.nodeAt(second[4], second[5])
+        if start is None or end is None:
+            return []
+        path = graph.shortestPath(start, end, self.maxVisits)
+        if path is None:
+            return []
+        return graph.coordinates(path[1:-1])
+
+    def ringRoute(self, key, firstVertexNr, secondVertexNr):
+        """ Return the coordinates between two vertices of a feature or None
+        if they are not on the same ring. """
+        geometry = self.geometries[key]
+        firstRing = geometry.ringIndex().lookup(firstVertexNr)
+        secondRing = geometry.ringIndex().lookup(secondVertexNr)
+        # Points have no rings
+        if firstRing is None or secondRing is None or firstRing[:2] != secondRing[:2]:
+            return None
+        part, ringNr, offset, count = firstRing
+        ring = geometry.ring(part, ringNr)
+        route = ring.route(firstVertexNr - offset, secondVertexNr - offset, self.byLength)
+        return ring.coordinates(route)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+    Tracing performance benchmarks on synthetic geometries.
+
+    Generates polygons, multipolygons with many holes and line networks of
+    1e3 to 1e6 vertices and times the work the map tool does on each
+    mouse move or commit:
+
+      ring lookup     - vertex number to part/ring (getPartAndRing)
+      route           - route choice by vertex count and by length
+                        (getAdditionalVerts), graph search for networks
+      slice           - copying a traced route out of the cached ring
+                        arrays (polygons)
+      assemble        - de-duplicating and packing the traced vertices
+                        into a geometry (sendGeometry)
+
+    Only the Qt-independent core is needed, so this runs outside QGIS.
+    Transforming geometries to map coordinates is left out as that is
+    QGIS' own work, done once per cached geometry rather than per route:
+
+      python benchmarks/traceBenchmark.py [--sizes 1000,10000] [--repeat 50] [--json out.json]
+
+    p50/p95 latencies are reported in milliseconds along with the peak
+    resident memory of each geometry. Every geometry is benchmarked in a
+    process of its own, so the peak is that geometry's and not the largest
+    one run so far.
+"""
+
+from __future__ import print_function
+
+import json
+import math
+import optparse
+import os
+import random
+import subprocess
+import sys
+import time
+from array import array
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from traceCore import Ring, RingIndex, dropRepeatedVertices, lineStringWkb, routeVertexCount, sliceRoute
+from traceGraph import TraceGraph
+
+
+def polygonRing(vertexCount, cx=0.0, cy=0.0, radius=1000.0):
+    """ A closed, slightly noisy circle as coordinate lists. """
+    xs = []
+    ys = []
+    for i in range(vertexCount - 1):
+        a = 2 * math.pi * i / (vertexCount - 1)
+        r = radius * (1.0 + 0.05 * random.random())
+        xs.append(cx + r * math.cos(a))
+        ys.append(cy + r * math.sin(a))
+    xs.append(xs[0])
+    ys.append(ys[0])
+    return xs, ys
+
+
+def generatePolygon(vertexCount):
+    return [[polygonRing(vertexCount)]]
+
+
+def generateMultiPolygon(vertexCount, verticesPerHole=5):
+    """ A few parts, each a large ring full of small square holes. """
+    parts = []
+    partCount = 4
+    perPart = vertexCount // partCount
+    for partNr in range(partCount):
+        cx = partNr * 3000.0
+        holeCount = max(1, (perPart // 2) // verticesPerHole)
+        rings = [polygonRing(perPart - holeCount * verticesPerHole, cx)]
+        side = int(math.ceil(math.sqrt(holeCount)))
+        step = 1200.0 / side
+        for h in range(holeCount):
+            x = cx - 600.0 + (h % side) * step
+            y = -600.0 + (h // side) * step
+            d = step / 4
+            rings.append(([x, x + d, x + d, x, x], [y, y, y + d, y + d, y]))
+        parts.append(rings)
+    return parts
+
+
+def generateLineNetwork(vertexCount, verticesPerLine=10):
+    """ A grid of lines sharing their end points, like a road network. """
+    lines = []
+    lineCount = max(2, vertexCount // verticesPerLine)
+    side = max(1, int(math.sqrt(lineCount / 2)))
+    spacing = 100.0
+    for row in range(side + 1):
+        for column in range(side):
+            x0, y = column * spacing, row * spacing
+            xs = [x0 + spacing * i / (verticesPerLine - 1) for i in range(verticesPerLine)]
+            lines.append((xs, [y] * verticesPerLine))
+            lines.append(([y] * verticesPerLine, xs))
+    return lines
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def timeIt(function, repeat):
+    samples = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        samples.append((time.time() - start) * 1000.0)
+    return {"p50": percentile(samples, 0.5), "p95": percentile(samples, 0.95)}
+
+
+def peakMemoryMb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def assemble(xs, ys):
+    """ The work of sendGeometry: drop repeated vertices and pack the rest
+    as WKB. """
+    xs, ys = dropRepeatedVertices(xs, ys)
+    return lineStringWkb(xs, ys)
+
+
+def benchmarkPolygon(name, parts, repeat):
+    rings = []
+    for partNr, part in enumerate(parts):
+        for ringNr, (xs, ys) in enumerate(part):
+            # Held as arrays, like the rings of the tool's geometry cache
+            rings.append((partNr, ringNr, Ring(array('d', xs), array('d', ys), True)))
+    index = RingIndex([(p, r, len(ring)) for p, r, ring in rings])
+    vertexCount = index.vertexCount
+    biggest = max(rings, key=lambda item: len(item[2]))[2]
+    count = len(biggest)
+
+    results = {}
+    results["ring lookup"] = timeIt(lambda: index.lookup(random.randrange(vertexCount)), repeat)
+    results["route by count"] = timeIt(lambda: biggest.route(random.randrange(count), random.randrange(count)), repeat)
+    biggest.lengths()  # one-off precompute, timed separately below
+    results["route by length"] = timeIt(lambda: biggest.route(random.randrange(count), random.randrange(count), True), repeat)
+    results["length precompute"] = timeIt(lambda: Ring(biggest.xs, biggest.ys, True).lengths(), max(1, repeat // 10))
+
+    route = biggest.route(0, count // 2, True)
+    results["slice"] = timeIt(lambda: (sliceRoute(biggest.xs, route), sliceRoute(biggest.ys, route)), max(1, repeat // 10))
+    xs = sliceRoute(biggest.xs, route)
+    ys = sliceRoute(biggest.ys, route)
+    results["assemble"] = timeIt(lambda: assemble(xs, ys), max(1, repeat // 10))
+    return name, vertexCount, routeVertexCount(route), results
+
+
+def benchmarkNetwork(name, lines, repeat):
+    graph = TraceGraph()
+    start = time.time()
+    for xs, ys in lines:
+        graph.addRing(zip(xs, ys))
+    buildTime = (time.time() - start) * 1000.0
+    vertexCount = sum(len(xs) for xs, ys in lines)
+    nodeCount = graph.nodeCount()
+
+    results = {"graph build": {"p50": buildTime, "p95": buildTime}}
+    paths = []
+
+    def search():
+        path = graph.shortestPath(random.randrange(nodeCount), random.randrange(nodeCount))
+        paths.append(path)
+    results["route (A*)"] = timeIt(search, max(1, repeat // 10))
+
+    path = max(paths, key=lambda p: len(p or []))
+    coords = graph.coordinates(path or [])
+    xs = [c[0] for c in coords]
+    ys = [c[1] for c in coords]
+    results["assemble"] = timeIt(lambda: assemble(xs, ys), max(1, repeat // 10))
+    return name, vertexCount, len(coords), results
+
+
+CASES = [("polygon", generatePolygon, benchmarkPolygon),
+         ("multipolygon", generateMultiPolygon, benchmarkPolygon),
+         ("line network", generateLineNetwork, benchmarkNetwork)]
+
+
+def runCase(caseName, size, repeat):
+    """ Benchmark one geometry, returning its report entry. """
+    random.seed(0)
+    for name, generate, run in CASES:
+        if name == caseName:
+            name, vertexCount, routeLength, results = run(name, generate(size), repeat)
+            return {"geometry": name, "size": size, "vertices": vertexCount,
+                    "routeVertices": routeLength, "peakMemoryMb": peakMemoryMb(), "stages": results}
+    raise ValueError("Unknown geometry: %s" % caseName)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--sizes", default="1000,10000,100000,1000000",
+                      help="comma separated vertex counts [%default]")
+    parser.add_option("--repeat", type="int", default=50,
+                      help="timed runs per measurement [%default]")
+    parser.add_option("--json", help="also write the results to this file")
+    parser.add_option("--case", help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.case:
+        # One geometry in a process of its own, see below
+        print(json.dumps(runCase(options.case, int(options.sizes), options.repeat)))
+        return
+
+    report = []
+    for size in [int(s) for s in options.sizes.split(",")]:
+        for name in [case[0] for case in CASES]:
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--case", name,
+                                              "--sizes", str(size), "--repeat", str(options.repeat)])
+            entry = json.loads(output.decode("utf-8"))
+            results = entry["stages"]
+            memory = entry["peakMemoryMb"]
+            print("%s, %d vertices (route of %d vertices)" % (name, entry["vertices"], entry["routeVertices"]))
+            for stage in sorted(results):
+                print("  %-18s p50 %10.3f ms   p95 %10.3f ms" % (stage, results[stage]["p50"], results[stage]["p95"]))
+            if memory is not None:
+                print("  peak memory %.1f MB" % memory)
+            report.append(entry)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
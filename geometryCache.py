@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+    Cache of the geometries the tracer snaps to.
+
+    While tracing, the same feature is needed on every mouse move. Fetching
+    it from the provider each time is a round trip per event on database
+    backed layers, so geometries are kept here keyed by (layer id, feature
+    id) and evicted least-recently-used first.
+
+    Entries are dropped when the layer tells us the geometry has changed,
+    the feature was deleted or editing stopped (feature ids of added
+    features change on commit).
+
+    Rings are handed out in map coordinates. Each geometry is transformed
+    from layer to map CRS in one go when it is cached, so the tracer never
+    has to transform vertices one at a time, and only its rings are kept,
+    as coordinate arrays.
+"""
+
+from array import array
+from collections import OrderedDict
+
+from PyQt4.QtCore import *
+from qgis.core import *
+
+from timings import timed
+from traceCore import Ring, RingIndex
+
+
+def layerToMapTransform(renderer, layer):
+    """ Return the transform from layer to map coordinates or None if
+    they are the same. """
+    if not renderer.hasCrsTransformEnabled() or layer.crs().authid() == renderer.destinationCrs().authid():
+        return None
+    return QgsCoordinateTransform(layer.crs(), renderer.destinationCrs())
+
+
+def geometryRings(geom):
+    """ Return the rings of a line or polygon geometry as a list of
+    (part, ring, [QgsPoint, ...]) in vertex order. Lines have one ring per
+    part. """
+    rings = []
+    if geom.type() == QGis.Line:
+        if geom.isMultipart():
+            lines = geom.asMultiPolyline()
+        else:
+            lines = [geom.asPolyline()]
+        for partNr, line in enumerate(lines):
+            rings.append((partNr, 0, line))
+    elif geom.type() == QGis.Polygon:
+        if geom.isMultipart():
+            polygons = geom.asMultiPolygon()
+        else:
+            polygons = [geom.asPolygon()]
+        for partNr, polygon in enumerate(polygons):
+            for ringNr, ring in enumerate(polygon):
+                rings.append((partNr, ringNr, ring))
+    return rings
+
+
+def geometryVertices(geom):
+    """ Return all vertices of a geometry in vertex order. """
+    if geom.type() == QGis.Point:
+        if geom.isMultipart():
+            return list(geom.asMultiPoint())
+        return [geom.asPoint()]
+    vertices = []
+    for part, ring, points in geometryRings(geom):
+        vertices.extend(points)
+    return vertices
+
+
+@timed("transform")
+def transformedGeometry(geometry, transform):
+    """ Return a copy of geometry transformed with transform, or geometry
+    itself if transform is None. """
+    if transform is None:
+        return geometry
+    geometry = QgsGeometry(geometry)
+    geometry.transform(transform)
+    return geometry
+
+
+class CachedGeometry:
+    """ The rings of a feature's geometry in map coordinates, copied into
+    coordinate arrays when the geometry is cached. Neither the geometry nor
+    its transformed copy is kept, only the arrays and the vertex counts of
+    the rings; lineStringWkb() and polygonWkb() turn rings back into
+    geometries. """
+
+    def __init__(self, geometry, transform=None):
+        self.geometryType = geometry.type()
+        self._ringArrays = {}
+        closed = self.geometryType == QGis.Polygon
+        counts = []
+        for part, ring, points in geometryRings(transformedGeometry(geometry, transform)):
+            counts.append((part, ring, len(points)))
+            self._ringArrays[(part, ring)] = Ring(array('d', [p.x() for p in points]),
+                                                  array('d', [p.y() for p in points]),
+                                                  closed)
+        self._ringIndex = RingIndex(counts)
+
+    def ringIndex(self):
+        return self._ringIndex
+
+    def ring(self, part, ring):
+        """ The given ring as a traceCore.Ring in map coordinates. """
+        return self._ringArrays[(part, ring)]
+
+
+class GeometryCache:
+
+    def __init__(self, layerToMapTransform, maxSize=128):
+        """ layerToMapTransform(layer) returns the QgsCoordinateTransform from
+        the layer to map coordinates or None if they are the same. """
+        self.layerToMapTransform = layerToMapTransform
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        # layer id -> (layer, [(signal, slot), ...])
+        self.watchedLayers = {}
+        QObject.connect(QgsMapLayerRegistry.instance(), SIGNAL("layersWillBeRemoved(QStringList)"), self.layersWillBeRemoved)
+
+    def entry(self, layer, featureId):
+        key = (layer.id(), featureId)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            geometry = self.fetch(layer, featureId)
+            if geometry is None:
+                return None
+            entry = CachedGeometry(geometry, self.layerToMapTransform(layer))
+            self.watchLayer(layer)
+            while len(self.entries) >= self.maxSize:
+                self.entries.popitem(last=False)
+        # (Re)insert at the most recently used end
+        self.entries[key] = entry
+        return entry
+
+    @timed("provider fetch")
+    def fetch(self, layer, featureId):
+        f = QgsFeature()
+        request = QgsFeatureRequest(featureId).setSubsetOfAttributes([])
+        if not layer.getFeatures(request).nextFeature(f) or f.geometry() is None:
+            return None
+        return QgsGeometry(f.geometry())
+
+    def invalidate(self, layerId, featureId):
+        self.entries.pop((layerId, featureId), None)
+
+    def invalidateLayer(self, layerId):
+        for key in [k for k in self.entries if k[0] == layerId]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+        for layerId in self.watchedLayers.keys():
+            self.unwatchLayer(layerId)
+
+    def shutdown(self):
+        """ Stop watching the layers, before the plugin goes away. """
+        self.clear()
+        QObject.disconnect(QgsMapLayerRegistry.instance(), SIGNAL("layersWillBeRemoved(QStringList)"), self.layersWillBeRemoved)
+
+    def watchLayer(self, layer):
+        layerId = layer.id()
+        if layerId in self.watchedLayers:
+            return
+        slots = [(SIGNAL("geometryChanged(QgsFeatureId,QgsGeometry&)"), lambda fid, geom: self.invalidate(layerId, fid)),
+                 (SIGNAL("featureDeleted(QgsFeatureId)"), lambda fid: self.invalidate(layerId, fid)),
+                 (SIGNAL("editingStopped()"), lambda: self.invalidateLayer(layerId))]
+        for signal, slot in slots:
+            QObject.connect(layer, signal, slot)
+        self.watchedLayers[layerId] = (layer, slots)
+
+    def unwatchLayer(self, layerId):
+        self.invalidateLayer(layerId)
+        layer, slots = self.watchedLayers.pop(layerId, (None, []))
+        for signal, slot in slots:
+            QObject.disconnect(layer, signal, slot)
+
+    def layersWillBeRemoved(self, layerIds):
+        for layerId in layerIds:
+            if layerId in self.watchedLayers:
+                self.unwatchLayer(layerId)
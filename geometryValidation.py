@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+    Checking traced geometries off the UI thread.
+
+    Long traces can take QGIS' own validator seconds, so a ValidationTask
+    runs on a worker thread while the feature form is open. GEOS is asked
+    first as it is fast; only if it finds the geometry invalid is the
+    QGIS validator run to find out what is wrong and where.
+"""
+
+from PyQt4.QtCore import *
+from qgis.core import *
+
+from timings import timed
+
+# What to do with geometries of more than /autoTrace/largeGeometryVertices vertices
+FULL_VALIDATION = "full"     # the same as any other geometry
+QUICK_VALIDATION = "quick"   # only ask GEOS whether it is valid, no error locations
+SKIP_VALIDATION = "skip"
+
+
+def estimatedVertexCount(geom):
+    """ Roughly the number of vertices of a geometry, from the size of its
+    WKB (16 bytes per 2D vertex) without visiting them. """
+    return len(geom.asWkb()) // 16
+
+
+class ValidationTask(QThread):
+    """
+        Validates a copy of a geometry on a worker thread. When the thread
+        has finished, errors is a list of (message, QgsPoint or None) and
+        empty if the geometry is valid.
+    """
+
+    def __init__(self, geometry, locateErrors=True):
+        QThread.__init__(self)
+        self.geometry = QgsGeometry(geometry)
+        self.locateErrors = locateErrors
+        self.errors = []
+
+    @timed("validation")
+    def run(self):
+        if self.geometry.isGeosValid():
+            return
+        if self.locateErrors:
+            for error in self.geometry.validateGeometry():
+                where = None
+                if error.hasWhere():
+                    where = QgsPoint(error.where())
+                self.errors.append((error.what(), where))
+        if len(self.errors) == 0:
+            self.errors.append(("Geometry is not valid according to GEOS", None))
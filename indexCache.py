@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+    Trace index data of whole layers, cached on disk between sessions.
+
+    Reading a big layer from its provider to build the trace index can
+    take minutes. The coordinates the index is built from are therefore
+    written, per layer, to a cache file next to the project and read back
+    from there as long as the layer's source, file size and modification
+    time (and those of a SQLite write-ahead log next to it), feature count
+    and coordinate reference system are unchanged.
+
+    A cache file holds a small JSON header followed by flat arrays:
+
+      fids                 feature ids
+      bboxes               xmin, ymin, xmax, ymax per feature
+      featureVertexStart   where each feature's vertices start (plus the end)
+      featureRingStart     where each feature's rings start (plus the end)
+      ringVertexStart      where each ring's vertices start
+      xs, ys               the vertices, in map coordinates
+
+    Everything is stored as doubles (exact for integers up to 2**53), so
+    the file is one array type on every platform; Python 2's array module
+    has no portable 64 bit integer type. Sections are spooled to temporary
+    files while a layer is read, so writing a cache takes little memory
+    however big the layer. Files are memory-mapped when read, so only the
+    pages holding the features in the current extent are actually read
+    from disk.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"ATIC"
+VERSION = 1
+SECTIONS = ["fids", "bboxes", "featureVertexStart", "featureRingStart", "ringVertexStart", "xs", "ys"]
+
+# Items held per section before they are appended to its spool file
+SPOOL_ITEMS = 65536
+
+
+def layerCacheKey(source, subsetString, featureCount, crs):
+    """ Return the key of a layer's cache file, or None if the layer's
+    source is not a local file whose modification time can be checked. """
+    path = source.split("|")[0]
+    if not os.path.isfile(path):
+        return None
+    # SQLite based sources (GeoPackage, SpatiaLite) in WAL mode write to a
+    # -wal file next to the database and leave the database itself alone
+    # until the next checkpoint
+    walPath = path + "-wal"
+    wal = None
+    if os.path.isfile(walPath):
+        wal = [os.path.getmtime(walPath), os.path.getsize(walPath)]
+    return {"version": VERSION,
+            "source": source,
+            "subset": subsetString,
+            "modified": os.path.getmtime(path),
+            "size": os.path.getsize(path),
+            "wal": wal,
+            "featureCount": featureCount,
+            "crs": crs}
+
+
+def layerCachePath(directory, key):
+    name = hashlib.sha1((u"%s|%s|%s" % (key["source"], key["subset"], key["crs"])).encode("utf-8")).hexdigest()
+    return os.path.join(directory, name + ".atidx")
+
+
+class LayerCacheWriter:
+    """
+        Streams the coordinates of a layer's features into a cache file.
+
+        Each section is spooled to a temporary file of its own and write()
+        joins them. If anything can not be written, failed is set, the
+        features that follow are ignored and write() returns False.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.failed = False
+        self.counts = dict((section, 0) for section in SECTIONS)
+        self.buffers = dict((section, array('d')) for section in SECTIONS)
+        self.spools = {}
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for section in SECTIONS:
+                self.spools[section] = open(self.spoolPath(section), "wb")
+        except (IOError, OSError):
+            self.abort()
+            return
+        self.append("featureVertexStart", [0])
+        self.append("featureRingStart", [0])
+
+    def spoolPath(self, section):
+        return "%s.%s.tmp" % (self.path, section)
+
+    def append(self, section, values):
+        buffer = self.buffers[section]
+        buffer.extend(values)
+        self.counts[section] += len(values)
+        if len(buffer) >= SPOOL_ITEMS:
+            self.flush(section)
+
+    def flush(self, section):
+        try:
+            self.buffers[section].tofile(self.spools[section])
+        except (IOError, OSError):
+            self.abort()
+            return
+        self.buffers[section] = array('d')
+
+    def addFeature(self, featureId, xs, ys, ringBounds):
+        """ Add a feature given its vertices and where its rings start and
+        end among them (empty for points). """
+        if len(xs) == 0 or self.failed:
+            return
+        vertexStart = self.counts["xs"]
+        self.append("fids", [featureId])
+        self.append("bboxes", [min(xs), min(ys), max(xs), max(ys)])
+        self.append("xs", xs)
+        self.append("ys", ys)
+        self.append("ringVertexStart", [vertexStart + bound for bound in ringBounds[:-1]])
+        self.append("featureVertexStart", [self.counts["xs"]])
+        self.append("featureRingStart", [self.counts["ringVertexStart"]])
+
+    def write(self):
+        """ Write the cache file, returns False if that was not possible. """
+        if self.failed:
+            return False
+        for section in SECTIONS:
+            self.flush(section)
+        if self.failed:
+            return False
+
+        header = {"key": self.key, "byteorder": sys.byteorder, "sections": {}}
+        # Offsets depend on the header length, which depends on the offsets: reserve enough digits
+        offset = 0
+        for section in SECTIONS:
+            header["sections"][section] = [offset, self.counts[section]]
+            offset += 8 * self.counts[section]
+        headerLength = len(json.dumps(header)) + 16 * len(SECTIONS)
+        headerLength += -headerLength % 8
+        start = len(MAGIC) + 4 + headerLength
+        for section in SECTIONS:
+            header["sections"][section][0] += start
+        headerBytes = json.dumps(header).encode("utf-8").ljust(headerLength)
+
+        try:
+            for spool in self.spools.values():
+                spool.close()
+            temporary = self.path + ".tmp"
+            with open(temporary, "wb") as f:
+                f.write(MAGIC)
+                f.write(struct.pack("<I", headerLength))
+                f.write(headerBytes)
+                for section in SECTIONS:
+                    with open(self.spoolPath(section), "rb") as spool:
+                        shutil.copyfileobj(spool, f)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temporary, self.path)
+        except (IOError, OSError):
+            self.abort()
+            return False
+        self.removeSpools()
+        return True
+
+    def abort(self):
+        """ Give up, removing the temporary files. """
+        self.failed = True
+        self.removeSpools()
+
+    def removeSpools(self):
+        for section, spool in self.spools.items():
+            try:
+                spool.close()
+                os.remove(self.spoolPath(section))
+            except (IOError, OSError):
+                pass
+        self.spools = {}
+
+
+class LayerCache:
+    """ A memory-mapped cache file. """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a trace index cache file")
+        headerLength = struct.unpack("<I", self.map[len(MAGIC):len(MAGIC) + 4])[0]
+        start = len(MAGIC) + 4
+        self.header = json.loads(self.map[start:start + headerLength].decode("utf-8"))
+        self.sections = self.header["sections"]
+
+    def matches(self, key):
+        return self.header["key"] == key and self.header["byteorder"] == sys.byteorder
+
+    def featureCount(self):
+        return self.sections["fids"][1]
+
+    def read(self, section, start=0, stop=None):
+        """ Return items start to stop of a section as a list. Only the
+        pages holding them are read. """
+        offset, count = self.sections[section]
+        if stop is None:
+            stop = count
+        if numpy is not None:
+            return numpy.frombuffer(self.map, dtype=float, count=stop - start, offset=offset + 8 * start).tolist()
+        return array('d', self.map[offset + 8 * start:offset + 8 * stop]).tolist()
+
+    def features(self, extent=None):
+        """ Yield (feature id, xs, ys, ring bounds) of the features whose
+        bounding box intersects extent, (xmin, ymin, xmax, ymax) in map
+        coordinates, or all of them. Only what is needed of the selected
+        features is read. """
+        if extent is None:
+            featureNrs = range(self.featureCount())
+        else:
+            xmin, ymin, xmax, ymax = extent
+            if numpy is not None:
+                offset, count = self.sections["bboxes"]
+                boxes = numpy.frombuffer(self.map, dtype=float, count=count, offset=offset).reshape(-1, 4)
+                inside = (boxes[:, 0] <= xmax) & (boxes[:, 2] >= xmin) & (boxes[:, 1] <= ymax) & (boxes[:, 3] >= ymin)
+                featureNrs = numpy.nonzero(inside)[0].tolist()
+            else:
+                boxes = self.read("bboxes")
+                featureNrs = [i for i in range(self.featureCount())
+                              if boxes[4*i] <= xmax and boxes[4*i+2] >= xmin and boxes[4*i+1] <= ymax and boxes[4*i+3] >= ymin]
+
+        for i in featureNrs:
+            vertexStart, vertexStop = [int(n) for n in self.read("featureVertexStart", i, i + 2)]
+            ringStart, ringStop = [int(n) for n in self.read("featureRingStart", i, i + 2)]
+            ringBounds = []
+            if ringStop > ringStart:
+                ringBounds = [int(bound) - vertexStart for bound in self.read("ringVertexStart", ringStart, ringStop)]
+                ringBounds.append(vertexStop - vertexStart)
+            fid = int(self.read("fids", i, i + 1)[0])
+            yield (fid, self.read("xs", vertexStart, vertexStop), self.read("ys", vertexStart, vertexStop), ringBounds)
+
+    def close(self):
+        # Arrays handed out by numpy may still refer to the map, leave it to the garbage collector
+        self.map = None
+        self.file.close()
+
+
+def openLayerCache(directory, key):
+    """ Return the LayerCache for key if there is an up to date one,
+    otherwise None. """
+    path = layerCachePath(directory, key)
+    if not os.path.isfile(path):
+        return None
+    try:
+        cache = LayerCache(path)
+        if cache.matches(key):
+            return cache
+        cache.close()
+    except (IOError, OSError, ValueError, KeyError):
+        pass  # Unreadable, rebuild it
+    return None
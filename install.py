@@ -45,6 +45,7 @@ if len(sys.argv) > 1:
 
 install_files = ['metadata.txt'] + glob.glob("*.py") + glob.glob("*.png")
 install_files.remove("install.py")  # exclude this file!
+install_files = [f for f in install_files if not f.startswith("test_")]  # and the tests
 
 if pkg:
   import zipfile
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+    Tests of indexCache, run with the other tests, see test_traceCore.
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import indexCache
+
+
+needsNumpy = unittest.skipIf(indexCache.numpy is None, "NumPy is not installed")
+
+
+class IndexCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(5)
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, "layer.shp")
+        open(self.source, "w").close()
+        self.cacheDirectory = os.path.join(self.directory, "cache")
+        self.spoolItems = indexCache.SPOOL_ITEMS
+        indexCache.SPOOL_ITEMS = 7  # spool several times per section
+        self.numpy = indexCache.numpy
+
+    def tearDown(self):
+        indexCache.SPOOL_ITEMS = self.spoolItems
+        indexCache.numpy = self.numpy
+        shutil.rmtree(self.directory)
+
+    def writeCache(self, featureCount=50):
+        """ Write a cache of random features, returning its key and the
+        features. """
+        key = indexCache.layerCacheKey(self.source, "", featureCount, "+proj=longlat")
+        writer = indexCache.LayerCacheWriter(indexCache.layerCachePath(self.cacheDirectory, key), key)
+        features = []
+        for fid in range(featureCount):
+            count = random.randint(1, 9)
+            xs = [random.uniform(0, 100) for i in range(count)]
+            ys = [random.uniform(0, 100) for i in range(count)]
+            ringBounds = [0, count] if count > 1 else []
+            features.append((fid, xs, ys, ringBounds))
+            writer.addFeature(fid, xs, ys, ringBounds)
+        self.assertTrue(writer.write())
+        return key, features
+
+    def checkRoundTrip(self):
+        key, features = self.writeCache()
+        self.assertEqual(os.listdir(self.cacheDirectory),
+                         [os.path.basename(indexCache.layerCachePath(self.cacheDirectory, key))])
+
+        otherKey = dict(key, featureCount=51)
+        self.assertEqual(indexCache.openLayerCache(self.cacheDirectory, otherKey), None)
+
+        cache = indexCache.openLayerCache(self.cacheDirectory, key)
+        self.assertNotEqual(cache, None)
+        try:
+            self.assertEqual([(fid, list(xs), list(ys), ringBounds) for fid, xs, ys, ringBounds in cache.features()],
+                             features)
+            extent = (10, 10, 30, 30)
+            expected = [fid for fid, xs, ys, ringBounds in features
+                        if min(xs) <= 30 and max(xs) >= 10 and min(ys) <= 30 and max(ys) >= 10]
+            self.assertEqual([f[0] for f in cache.features(extent)], expected)
+        finally:
+            cache.close()
+
+    def testRoundTrip(self):
+        indexCache.numpy = None
+        self.checkRoundTrip()
+
+    @needsNumpy
+    def testRoundTripNumpy(self):
+        self.checkRoundTrip()
+
+    def testTileReads(self):
+        # Tiles are loaded one at a time, each reading the features it touches
+        key, features = self.writeCache(200)
+        cache = indexCache.openLayerCache(self.cacheDirectory, key)
+        try:
+            size = 25.0
+            featureTiles = {}
+            for column in range(4):
+                for row in range(4):
+                    extent = (column * size, row * size, (column + 1) * size, (row + 1) * size)
+                    for fid, xs, ys, ringBounds in cache.features(extent):
+                        featureTiles.setdefault(fid, set()).add((column, row))
+        finally:
+            cache.close()
+        for fid, xs, ys, ringBounds in features:
+            columns = range(int(min(xs) // size), int(max(xs) // size) + 1)
+            rows = range(int(min(ys) // size), int(max(ys) // size) + 1)
+            self.assertEqual(featureTiles[fid], set((column, row) for column in columns for row in rows))
+
+    def testKeyFollowsWriteAheadLog(self):
+        key = indexCache.layerCacheKey(self.source, "", 1, "+proj=longlat")
+        with open(self.source + "-wal", "w") as f:
+            f.write("x")
+        walKey = indexCache.layerCacheKey(self.source, "", 1, "+proj=longlat")
+        self.assertNotEqual(walKey, key)
+        with open(self.source + "-wal", "a") as f:
+            f.write("x")
+        self.assertNotEqual(indexCache.layerCacheKey(self.source, "", 1, "+proj=longlat"), walKey)
+        self.assertEqual(indexCache.layerCachePath(self.cacheDirectory, walKey),
+                         indexCache.layerCachePath(self.cacheDirectory, key))
+
+    def testFailedWrite(self):
+        key = indexCache.layerCacheKey(self.source, "", 1, "+proj=longlat")
+        # A directory can not be made below a regular file
+        writer = indexCache.LayerCacheWriter(os.path.join(self.source, "cache", "layer.atidx"), key)
+        writer.addFeature(1, [1.0], [2.0], [])
+        self.assertTrue(writer.failed)
+        self.assertFalse(writer.write())
+
+
+if __name__ == "__main__":
+    unittest.main()
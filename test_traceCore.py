@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+    Tests of traceCore. Like the modules they test they need neither Qt
+    nor QGIS; run them from the plugin directory with
+
+        python -m unittest discover -p "test_*.py"
+"""
+
+import random
+import struct
+import unittest
+from array import array
+from math import hypot
+
+import traceCore
+from traceCore import WKB_LINESTRING, WKB_POLYGON, cumulativeLengths, decimate, dropRepeatedVertices, lineStringWkb, \
+    polygonWkb, positionLength, ringRoutes, routeVertexCount, skipRoute, sliceRoute, sliceRun
+
+
+def expand(runs):
+    """ The vertex numbers of a route. """
+    vertices = []
+    for start, stop, step in runs:
+        vertices.extend(range(start, stop, step))
+    return vertices
+
+
+def withoutNumpy(function, *args):
+    """ Call function with traceCore on its pure Python code paths, whether
+    or not NumPy is installed. """
+    numpy = traceCore.numpy
+    traceCore.numpy = None
+    try:
+        return function(*args)
+    finally:
+        traceCore.numpy = numpy
+
+
+needsNumpy = unittest.skipIf(traceCore.numpy is None, "NumPy is not installed")
+
+
+def baselineAdditionalVerts(vertCount, firstVertexNr, secondVertexNr, polygon, ctrl):
+    """ The route between two vertices as the original
+    VertexTracerTool.getAdditionalVerts() worked it out. """
+    if firstVertexNr == secondVertexNr:
+        return []
+    largerNr = max(firstVertexNr, secondVertexNr)
+    smallerNr = min(firstVertexNr, secondVertexNr)
+    if polygon:
+        if ((firstVertexNr == vertCount-1) and (secondVertexNr == 0)) or ((secondVertexNr == vertCount-1) and (firstVertexNr == 0)):
+            return []
+        joinFaster = False
+        normalDistance = largerNr - smallerNr
+        joinDistance = (vertCount - largerNr - 1) + smallerNr
+        if joinDistance < normalDistance:
+            joinFaster = True
+        if ctrl:
+            joinFaster = not(joinFaster)
+        if joinFaster:
+            if secondVertexNr > firstVertexNr:
+                return list(range(firstVertexNr-1, -1, -1)) + list(range(vertCount-2, secondVertexNr, -1))
+            else:
+                return list(range(firstVertexNr+1, vertCount, 1)) + list(range(1, secondVertexNr, 1))
+    if secondVertexNr > firstVertexNr:
+        return list(range(firstVertexNr+1, secondVertexNr, 1))
+    else:
+        return list(range(firstVertexNr-1, secondVertexNr, -1))
+
+
+def randomRing(count, closed):
+    xs = [random.uniform(0, 100) for i in range(count)]
+    ys = [random.uniform(0, 100) for i in range(count)]
+    if closed:
+        xs[-1], ys[-1] = xs[0], ys[0]
+    return xs, ys
+
+
+def pointAt(xs, ys, position):
+    vertexNr = int(position)
+    fraction = position - vertexNr
+    if fraction == 0:
+        return xs[vertexNr], ys[vertexNr]
+    return (xs[vertexNr] + fraction * (xs[vertexNr + 1] - xs[vertexNr]),
+            ys[vertexNr] + fraction * (ys[vertexNr + 1] - ys[vertexNr]))
+
+
+def pathLength(points):
+    return sum(hypot(b[0] - a[0], b[1] - a[1]) for a, b in zip(points, points[1:]))
+
+
+class RingRoutesTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+
+    def testMatchesBaseline(self):
+        for count in range(2, 12):
+            for polygon in (False, True):
+                for first in range(count):
+                    for second in range(count):
+                        shorter, longer = ringRoutes(count, first, second, polygon)
+                        self.assertEqual(expand(shorter), baselineAdditionalVerts(count, first, second, polygon, False))
+                        self.assertEqual(expand(longer), baselineAdditionalVerts(count, first, second, polygon, True))
+
+
+    def testLineFractionalPositions(self):
+        for i in range(2000):
+            count = random.randint(2, 11)
+            first = random.uniform(0, count - 1)
+            second = random.choice([random.uniform(0, count - 1), float(random.randint(0, count - 1))])
+            shorter, longer = ringRoutes(count, first, second, False)
+            if second > first:
+                expected = [v for v in range(count) if first < v < second]
+            else:
+                expected = [v for v in range(count - 1, -1, -1) if second < v < first]
+            self.assertEqual(expand(shorter), expected)
+            self.assertEqual(expand(longer), expected)
+
+    def testClosedFractionalPositions(self):
+        for i in range(2000):
+            count = random.randint(4, 11)
+            xs, ys = randomRing(count, True)
+            lengths = cumulativeLengths(xs, ys)
+            first = random.uniform(0, count - 1)
+            second = random.choice([random.uniform(0, count - 1), float(random.randint(0, count - 1))])
+            shorter, longer = ringRoutes(count, first, second, True, lengths)
+
+            # Both ways round the ring, with vertex count-1 being vertex 0
+            n = count - 1
+            upEnd = second if second > first else second + n
+            downEnd = second if second < first else second - n
+            up = [v % n for v in range(int(first) + 1, n * 2) if first < v < upEnd]
+            down = [v % n for v in range(int(first) + 1, -n, -1) if downEnd < v < first]
+            start, end = pointAt(xs, ys, first), pointAt(xs, ys, second)
+            ways = sorted((pathLength([start] + [(xs[v], ys[v]) for v in way] + [end]), way) for way in (up, down))
+
+            # Like the original tool, the way through the closing vertex
+            # ends on the other copy of it when second is the first or
+            # last vertex
+            def wrapped(route):
+                vertices = [v % n for v in expand(route)]
+                if second in (0, count - 1) and vertices and vertices[-1] == 0:
+                    vertices.pop()
+                return vertices
+            self.assertEqual(wrapped(shorter), ways[0][1])
+            self.assertEqual(wrapped(longer), ways[1][1])
+
+    def testPositionLength(self):
+        lengths = cumulativeLengths([0.0, 3.0, 3.0], [0.0, 0.0, 4.0])
+        self.assertEqual(positionLength(lengths, 1), 3.0)
+        self.assertEqual(positionLength(lengths, 0.5), 1.5)
+        self.assertEqual(positionLength(lengths, 1.25), 4.0)
+
+
+class CumulativeLengthsTest(unittest.TestCase):
+
+    def checkCumulativeLengths(self):
+        lengths = cumulativeLengths([0.0, 3.0, 3.0, 0.0], [0.0, 0.0, 4.0, 0.0])
+        self.assertTrue(isinstance(lengths, array))
+        self.assertEqual(list(lengths), [0.0, 3.0, 7.0, 12.0])
+        self.assertEqual(list(cumulativeLengths([1.0], [1.0])), [0.0])
+        self.assertEqual(list(cumulativeLengths([], [])), [])
+
+    def testPurePython(self):
+        withoutNumpy(self.checkCumulativeLengths)
+
+    @needsNumpy
+    def testNumpy(self):
+        self.checkCumulativeLengths()
+
+
+class RouteTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+
+    def randomRoutes(self):
+        for i in range(500):
+            count = random.randint(2, 11)
+            first, second = random.randint(0, count - 1), random.randint(0, count - 1)
+            for route in ringRoutes(count, first, second, random.random() < 0.5):
+                yield count, route
+
+    def testSkipRoute(self):
+        for count, route in self.randomRoutes():
+            for skip in range(routeVertexCount(route) + 2):
+                self.assertEqual(expand(skipRoute(route, skip)), expand(route)[skip:])
+
+    def testSliceRun(self):
+        items = list(range(100, 111))
+        for start in range(len(items)):
+            for stop in range(-1, len(items) + 1):
+                for step in (1, -1):
+                    self.assertEqual(sliceRun(items, (start, stop, step)),
+                                     [items[v] for v in range(start, stop, step)])
+
+    def testSliceRoute(self):
+        for count, route in self.randomRoutes():
+            items = [float(v) for v in range(count)]
+            expected = [items[v] for v in expand(route)]
+            self.assertEqual(sliceRoute(items, route), expected)
+            sliced = sliceRoute(array('d', items), route)
+            self.assertTrue(isinstance(sliced, array))
+            self.assertEqual(list(sliced), expected)
+
+
+class DecimateTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(3)
+        self.xs, self.ys = [0.0], [0.0]
+        for i in range(2000):
+            self.xs.append(self.xs[-1] + random.uniform(-1, 1))
+            self.ys.append(self.ys[-1] + random.uniform(-1, 1))
+
+    def cell(self, x, y, cellSize):
+        return (int(x // cellSize), int(y // cellSize))
+
+    def checkDecimate(self):
+        xs, ys = self.xs, self.ys
+        for cellSize in (0.5, 2.0, 10.0):
+            kept = decimate(xs, ys, cellSize)
+            self.assertEqual(kept[0], 0)
+            keptSet = set(kept)
+            for i in range(1, len(xs)):
+                changed = self.cell(xs[i], ys[i], cellSize) != self.cell(xs[i-1], ys[i-1], cellSize)
+                self.assertEqual(i in keptSet, changed)
+
+    def testDecimate(self):
+        withoutNumpy(self.checkDecimate)
+
+    @needsNumpy
+    def testDecimateNumpy(self):
+        self.checkDecimate()
+        for cellSize in (0.5, 2.0, 10.0):
+            self.assertEqual(decimate(array('d', self.xs), array('d', self.ys), cellSize),
+                             withoutNumpy(decimate, self.xs, self.ys, cellSize))
+
+    def testDegenerate(self):
+        for function in (decimate, lambda *args: withoutNumpy(decimate, *args)):
+            self.assertEqual(function([], [], 1.0), [])
+            self.assertEqual(function([1.0, 1.1, 1.2], [1.0, 1.0, 1.0], 0), [0, 1, 2])
+            self.assertEqual(function([1.0], [1.0], 1.0), [0])
+
+
+class WkbTest(unittest.TestCase):
+
+    xs = [0.0, 0.0, 1.5, 1.5, -2.25, 0.0]
+    ys = [0.0, 0.0, 0.0, 3.0, 3.0, 3.0]
+
+    def coordinates(self, wkb, offset, count):
+        values = struct.unpack_from("<%dd" % (2 * count), wkb, offset)
+        return list(values[0::2]), list(values[1::2])
+
+    def checkDropRepeatedVertices(self):
+        xs, ys = dropRepeatedVertices(self.xs, self.ys)
+        self.assertTrue(isinstance(xs, array) and isinstance(ys, array))
+        self.assertEqual(list(xs), [0.0, 1.5, 1.5, -2.25, 0.0])
+        self.assertEqual(list(ys), [0.0, 0.0, 3.0, 3.0, 3.0])
+        xs, ys = dropRepeatedVertices([1.0], [2.0])
+        self.assertEqual((list(xs), list(ys)), ([1.0], [2.0]))
+
+    def checkLineString(self):
+        wkb = lineStringWkb(array('d', self.xs), array('d', self.ys))
+        self.assertEqual(len(wkb), 9 + 16 * len(self.xs))
+        self.assertEqual(struct.unpack_from("<BII", wkb), (1, WKB_LINESTRING, len(self.xs)))
+        self.assertEqual(self.coordinates(wkb, 9, len(self.xs)), (self.xs, self.ys))
+
+    def checkPolygon(self):
+        xs, ys = [0.0, 4.0, 4.0, 0.0], [0.0, 0.0, 2.0, 2.0]
+        for closed in (False, True):
+            ringXs = xs + [xs[0]] if closed else xs
+            ringYs = ys + [ys[0]] if closed else ys
+            wkb = polygonWkb(array('d', ringXs), array('d', ringYs))
+            # Closed once, however it was given
+            self.assertEqual(len(wkb), 13 + 16 * 5)
+            self.assertEqual(struct.unpack_from("<BIII", wkb), (1, WKB_POLYGON, 1, 5))
+            self.assertEqual(self.coordinates(wkb, 13, 5), (xs + [xs[0]], ys + [ys[0]]))
+
+    def testPurePython(self):
+        withoutNumpy(self.checkDropRepeatedVertices)
+        withoutNumpy(self.checkLineString)
+        withoutNumpy(self.checkPolygon)
+
+    @needsNumpy
+    def testNumpy(self):
+        self.checkDropRepeatedVertices()
+        self.checkLineString()
+        self.checkPolygon()
+
+
+if __name__ == "__main__":
+    unittest.main()
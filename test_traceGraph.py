@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+    Tests of traceGraph, run with the other tests, see test_traceCore.
+"""
+
+import random
+import unittest
+
+from traceGraph import PathSearch, TraceGraph
+
+
+class TraceGraphTest(unittest.TestCase):
+
+    def testRemoveOwner(self):
+        graph = TraceGraph()
+        # Two squares sharing the edge from (1, 0) to (1, 1)
+        left = [(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]
+        right = [(1, 0), (2, 0), (2, 1), (1, 1), (1, 0)]
+        graph.addRing(left, "left")
+        graph.addRing(right, "right")
+        self.assertEqual(graph.nodeCount(), 6)
+        shared = tuple(sorted((graph.nodeAt(1, 0), graph.nodeAt(1, 1))))
+        self.assertEqual(graph.edgeRefs[shared], 2)
+
+        graph.removeOwner("left")
+        self.assertEqual(graph.nodeCount(), 4)
+        self.assertEqual(graph.nodeAt(0, 0), None)
+        self.assertEqual(graph.nodeAt(0, 1), None)
+        self.assertEqual(graph.edgeRefs[shared], 1)
+        path = graph.shortestPath(graph.nodeAt(1, 0), graph.nodeAt(1, 1))
+        self.assertEqual(graph.coordinates(path), [(1, 0), (1, 1)])
+
+        # The freed node ids are used again
+        nodeIds = len(graph.xs)
+        graph.addRing(left, "left")
+        self.assertEqual(len(graph.xs), nodeIds)
+        self.assertEqual(graph.nodeCount(), 6)
+
+        graph.removeOwner("left")
+        graph.removeOwner("right")
+        self.assertEqual(graph.nodeCount(), 0)
+        self.assertEqual(graph.edgeRefs, {})
+        self.assertEqual(graph.nodeIds, {})
+        self.assertTrue(all(len(edges) == 0 for edges in graph.edges))
+
+    def testRemoveUnknownOwner(self):
+        graph = TraceGraph()
+        graph.addRing([(0, 0), (1, 0)], "line")
+        graph.removeOwner("other")
+        self.assertEqual(graph.nodeCount(), 2)
+
+
+
+class PathSearchTest(unittest.TestCase):
+
+    def gridGraph(self, size):
+        """ A graph of the lines of a size x size grid with a few gaps. """
+        random.seed(6)
+        graph = TraceGraph()
+        for i in range(size):
+            for j in range(size - 1):
+                if random.random() < 0.8:
+                    graph.addRing([(i, j), (i, j + 1)], ("column", i, j))
+                if random.random() < 0.8:
+                    graph.addRing([(j, i), (j + 1, i)], ("row", i, j))
+        return graph
+
+    def testSlicesMatchWholeSearch(self):
+        graph = self.gridGraph(30)
+        for i in range(50):
+            start = graph.nodeAt(random.randrange(30), random.randrange(30))
+            end = graph.nodeAt(random.randrange(30), random.randrange(30))
+            if start is None or end is None:
+                continue
+            expected = graph.shortestPath(start, end)
+            search = PathSearch(graph, start, end)
+            slices = 1
+            while not search.run(7):
+                slices += 1
+            self.assertEqual(search.path, expected)
+            self.assertTrue(search.visits <= 7 * slices)
+            self.assertTrue(search.run(7))
+
+    def testMaxVisits(self):
+        graph = TraceGraph()
+        graph.addRing([(x, 0) for x in range(100)], "line")
+        graph.addRing([(0, 1), (1, 1)], "unreachable")
+        start, end = graph.nodeAt(0, 0), graph.nodeAt(99, 0)
+        self.assertEqual(graph.shortestPath(start, end, 50), None)
+        self.assertEqual(len(graph.shortestPath(start, end, 100)), 100)
+        self.assertEqual(graph.shortestPath(start, start), [start])
+        search = PathSearch(graph, start, graph.nodeAt(1, 1))
+        self.assertTrue(search.run())
+        self.assertEqual(search.path, None)
+        self.assertEqual(search.visits, 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
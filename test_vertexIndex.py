@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+    Tests of vertexIndex, run with the other tests, see test_traceCore.
+"""
+
+import random
+import unittest
+from math import hypot
+
+from vertexIndex import SegmentGrid, projectOntoSegment
+
+
+class SegmentGridTest(unittest.TestCase):
+
+    def testNearestMatchesBruteForce(self):
+        random.seed(1)
+        grid = SegmentGrid(5.0)
+        features = {}
+        for key in range(30):
+            count = random.randint(2, 8)
+            xs = [random.uniform(0, 100) for i in range(count)]
+            ys = [random.uniform(0, 100) for i in range(count)]
+            features[key] = (xs, ys)
+            grid.addFeature(key, xs, ys, [0, count])
+        for key in range(0, 30, 3):
+            grid.removeFeature(key)
+            del features[key]
+        self.assertEqual(grid.featureCount(), len(features))
+
+        for i in range(500):
+            x, y = random.uniform(-10, 110), random.uniform(-10, 110)
+            tolerance = random.uniform(0.5, 10)
+            best = None
+            for key, (xs, ys) in features.items():
+                for vertexNr in range(len(xs) - 1):
+                    fraction, px, py = projectOntoSegment(x, y, xs[vertexNr], ys[vertexNr], xs[vertexNr + 1], ys[vertexNr + 1])
+                    distance = hypot(px - x, py - y)
+                    if distance <= tolerance and (best is None or distance < best):
+                        best = distance
+            nearest = grid.nearest(x, y, tolerance)
+            if best is None:
+                self.assertEqual(nearest, None)
+            else:
+                self.assertAlmostEqual(nearest[0], best)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+    Opt-in timing of the plugin's hot paths.
+
+    Methods decorated with @timed("stage") record how long each call took
+    into a rolling window per stage, but only while recording is switched
+    on. When it is off the cost is one attribute check per call.
+
+    One-off stages such as the plugin's startup are always recorded with
+    recordSince(), so their cost can be checked after the fact.
+
+    Recorded timings can be summarised as text (percentiles and a
+    histogram per stage) or exported as JSON.
+"""
+
+import json
+import sys
+import time
+from collections import deque
+from functools import wraps
+
+if sys.platform == "win32":
+    clock = time.clock
+else:
+    clock = time.time
+
+# Upper bounds (ms) of the histogram buckets, the last bucket is open ended
+BUCKETS = [0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000]
+
+
+class Timings:
+
+    def __init__(self, windowSize=1000):
+        self.enabled = False
+        self.windowSize = windowSize
+        self.samples = {}   # stage -> deque of durations in ms
+
+    def record(self, stage, milliseconds):
+        window = self.samples.get(stage)
+        if window is None:
+            window = deque(maxlen=self.windowSize)
+            self.samples[stage] = window
+        window.append(milliseconds)
+
+    def stageSummary(self, stage):
+        ordered = sorted(self.samples[stage])
+        count = len(ordered)
+        histogram = [0] * (len(BUCKETS) + 1)
+        for ms in ordered:
+            bucket = 0
+            while bucket < len(BUCKETS) and ms >= BUCKETS[bucket]:
+                bucket += 1
+            histogram[bucket] += 1
+        return {"count": count,
+                "mean": sum(ordered) / count,
+                "p50": ordered[int(0.5 * (count - 1))],
+                "p95": ordered[int(0.95 * (count - 1))],
+                "max": ordered[-1],
+                "histogram": histogram}
+
+    def summary(self):
+        """ Return {stage: summary} for every stage with samples. """
+        return dict((stage, self.stageSummary(stage)) for stage in self.samples if self.samples[stage])
+
+    def summaryText(self):
+        summary = self.summary()
+        if not summary:
+            return "No timings recorded"
+        labels = ["<%g" % b for b in BUCKETS] + [">=%g" % BUCKETS[-1]]
+        lines = ["Timings in ms over the last %d calls per stage" % self.windowSize]
+        for stage in sorted(summary):
+            s = summary[stage]
+            lines.append("%s: n=%d mean=%.2f p50=%.2f p95=%.2f max=%.2f" %
+                         (stage, s["count"], s["mean"], s["p50"], s["p95"], s["max"]))
+            lines.append("    " + "  ".join("%s:%d" % (label, n) for label, n in zip(labels, s["histogram"]) if n))
+        return "\n".join(lines)
+
+    def toJson(self):
+        return json.dumps({"buckets": BUCKETS,
+                           "stages": self.summary(),
+                           "samples": dict((stage, list(window)) for stage, window in self.samples.items())},
+                          indent=2)
+
+
+timings = Timings()
+
+
+def recordSince(stage, start):
+    """ Record the time since start (a clock() reading) under stage, even
+    while timings are disabled. """
+    timings.record(stage, (clock() - start) * 1000.0)
+
+
+def timed(stage):
+    """ Decorator recording the duration of each call under stage while
+    timings are enabled. """
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not timings.enabled:
+                return function(*args, **kwargs)
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings.record(stage, (clock() - start) * 1000.0)
+        return wrapper
+    return decorate
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+    The tracing algorithm, independent of Qt and QGIS.
+
+    Rings (and lines) are held as arrays of x and y coordinates. A route
+    between two vertices of a ring is returned as a list of runs, each a
+    (start, stop, step) triple like the arguments of range(). Runs can be
+    expanded into vertex numbers or used to slice coordinate sequences
+    without touching every vertex from Python.
+
+    NumPy is used where it helps if it is installed, everything also works
+    without it.
+"""
+
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from math import ceil, floor, hypot
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class RingIndex:
+    """
+        Cumulative vertex offsets of the rings of a geometry, in the order
+        QgsGeometry.vertexAt() numbers its vertices (part by part, ring by
+        ring). Lines have one ring per part.
+
+        Finding the ring a vertex number belongs to is a binary search over
+        the offsets.
+    """
+
+    def __init__(self, rings):
+        """ rings is a sequence of (part, ring, vertex count) tuples in
+        vertex order. """
+        self.rings = []
+        self.offsets = []
+        self.ringNrs = {}
+        offset = 0
+        for part, ring, count in rings:
+            self.ringNrs[(part, ring)] = len(self.rings)
+            self.rings.append((part, ring, count))
+            self.offsets.append(offset)
+            offset += count
+        self.vertexCount = offset
+
+    def lookup(self, vertexNr):
+        """ Return (part, ring, ring vertex offset, ring vertex count) for
+        vertexNr or None if the geometry has no such vertex. """
+        if vertexNr < 0 or vertexNr >= self.vertexCount:
+            return None
+        i = bisect_right(self.offsets, vertexNr) - 1
+        part, ring, count = self.rings[i]
+        return part, ring, self.offsets[i], count
+
+
+def cumulativeLengths(xs, ys):
+    """ Return an array whose i-th item is the length of the ring (or line)
+    from its first vertex up to vertex i. """
+    if numpy is not None and len(xs) > 1:
+        lengths = numpy.zeros(len(xs))
+        numpy.cumsum(numpy.hypot(numpy.diff(xs), numpy.diff(ys)), out=lengths[1:])
+        return array('d', lengths.tolist())
+    lengths = array('d', [0.0]) * len(xs)
+    total = 0.0
+    for i in range(1, len(xs)):
+        total += hypot(xs[i] - xs[i-1], ys[i] - ys[i-1])
+        lengths[i] = total
+    return lengths
+
+
+def positionLength(lengths, position):
+    """ The length along a ring up to a position, see ringRoutes(). """
+    vertexNr = int(floor(position))
+    fraction = position - vertexNr
+    if fraction == 0:
+        return lengths[vertexNr]
+    return lengths[vertexNr] + fraction * (lengths[vertexNr + 1] - lengths[vertexNr])
+
+
+def ringRoutes(count, first, second, closed, lengths=None):
+    """
+        Return the (shorter, longer) routes between vertices first and
+        second of a ring of count vertices, not including first and second
+        themselves. Routes are lists of runs.
+
+        first and second may also be positions part of the way along a
+        segment: vertex i plus the fraction of the way to vertex i+1. The
+        routes then consist of the vertices between the two positions.
+
+        For closed rings (whose last vertex repeats the first) there are
+        two ways round; the shorter is judged by length if the cumulative
+        lengths are given and by number of vertices if not. Lines only have
+        the one route, which is returned as both.
+    """
+    if first == second:
+        return [], []
+    if closed and ((first == count-1 and second == 0) or (second == count-1 and first == 0)):
+        return [], []
+
+    # The nearest vertices past each position, going up and going down
+    firstUp, firstDown = int(floor(first)) + 1, int(ceil(first)) - 1
+    secondUp, secondDown = int(ceil(second)), int(floor(second))
+
+    if second > first:
+        normal = [(firstUp, secondUp, 1)]
+    else:
+        normal = [(firstDown, secondDown, -1)]
+    if not closed:
+        return normal, normal
+
+    # The way round through the first/last vertex of the ring
+    if second > first:
+        join = [(firstDown, -1, -1), (count-2, secondDown, -1)]
+    else:
+        join = [(firstUp, count, 1), (1, secondUp, 1)]
+
+    larger = max(first, second)
+    smaller = min(first, second)
+    if lengths is not None:
+        normalDistance = positionLength(lengths, larger) - positionLength(lengths, smaller)
+        joinDistance = lengths[count-1] - normalDistance
+    else:
+        normalDistance = larger - smaller
+        joinDistance = (count - larger - 1) + smaller
+
+    if joinDistance < normalDistance:
+        return join, normal
+    return normal, join
+
+
+def runLength(run):
+    start, stop, step = run
+    return max(0, (stop - start) * step)
+
+
+def routeVertexCount(runs):
+    return sum(runLength(run) for run in runs)
+
+
+def skipRoute(runs, skip):
+    """ Return the route without its first skip vertices. """
+    remaining = []
+    for start, stop, step in runs:
+        length = runLength((start, stop, step))
+        if skip >= length:
+            skip -= length
+            continue
+        remaining.append((start + skip * step, stop, step))
+        skip = 0
+    return remaining
+
+
+def sliceRun(sequence, run):
+    start, stop, step = run
+    if runLength(run) == 0:
+        return sequence[0:0]
+    if step > 0:
+        return sequence[start:stop]
+    if stop < 0:
+        return sequence[start::-1]
+    return sequence[start:stop:-1]
+
+
+def sliceRoute(sequence, runs):
+    """ Return the items of sequence (e.g. the vertices of a ring) along a
+    route, as a sequence of the same type: slicing an array gives an
+    array, without making a Python object of every item. """
+    items = sequence[0:0]
+    for run in runs:
+        items += sliceRun(sequence, run)
+    return items
+
+
+def decimate(xs, ys, cellSize):
+    """
+        Return the indices of the vertices worth drawing at a resolution of
+        cellSize map units (e.g. the size of a screen pixel): of each run of
+        consecutive vertices falling into the same cell of a grid only the
+        first is kept. The result depends on the number of cells the path
+        crosses rather than on its number of vertices.
+    """
+    count = len(xs)
+    if count == 0:
+        return []
+    if cellSize <= 0:
+        return list(range(count))
+    if numpy is not None and count > 1:
+        cellXs = numpy.floor(numpy.asarray(xs, dtype=float) / cellSize)
+        cellYs = numpy.floor(numpy.asarray(ys, dtype=float) / cellSize)
+        changed = (cellXs[1:] != cellXs[:-1]) | (cellYs[1:] != cellYs[:-1])
+        return [0] + (numpy.nonzero(changed)[0] + 1).tolist()
+    kept = []
+    lastCell = None
+    for i in range(count):
+        cell = (int(xs[i] // cellSize), int(ys[i] // cellSize))
+        if cell != lastCell:
+            kept.append(i)
+            lastCell = cell
+    return kept
+
+
+def toBytes(buffer):
+    """ The contents of an array or NumPy array as a byte string, whichever
+    the Python and NumPy versions call it. """
+    if hasattr(buffer, "tobytes"):
+        return buffer.tobytes()
+    return buffer.tostring()
+
+
+def dropRepeatedVertices(xs, ys):
+    """ Return the coordinates as arrays without vertices that repeat the
+    one before them. """
+    if numpy is not None and len(xs) > 1:
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        keep = numpy.ones(len(xs), dtype=bool)
+        keep[1:] = (xs[1:] != xs[:-1]) | (ys[1:] != ys[:-1])
+        return array('d', toBytes(xs[keep])), array('d', toBytes(ys[keep]))
+    keptXs = array('d')
+    keptYs = array('d')
+    last = None
+    for pt in zip(xs, ys):
+        if pt != last:
+            keptXs.append(pt[0])
+            keptYs.append(pt[1])
+            last = pt
+    return keptXs, keptYs
+
+
+WKB_LINESTRING = 2
+WKB_POLYGON = 3
+
+
+def packCoordinates(xs, ys):
+    """ Return the coordinates interleaved (x, y, x, y...) as little endian
+    doubles. """
+    if numpy is not None:
+        packed = numpy.empty(2 * len(xs), dtype='<f8')
+        packed[0::2] = xs
+        packed[1::2] = ys
+        return toBytes(packed)
+    packed = array('d', [0.0]) * (2 * len(xs))
+    packed[0::2] = array('d', xs)
+    packed[1::2] = array('d', ys)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return toBytes(packed)
+
+
+def lineStringWkb(xs, ys):
+    """ Return the WKB of a line string through the given vertices. """
+    return struct.pack("<BII", 1, WKB_LINESTRING, len(xs)) + packCoordinates(xs, ys)
+
+
+def polygonWkb(xs, ys):
+    """ Return the WKB of a polygon with the given exterior ring, which is
+    closed if it is not already. """
+    if len(xs) > 0 and (xs[0] != xs[-1] or ys[0] != ys[-1]):
+        xs = array('d', xs)
+        ys = array('d', ys)
+        xs.append(xs[0])
+        ys.append(ys[0])
+    return struct.pack("<BIII", 1, WKB_POLYGON, 1, len(xs)) + packCoordinates(xs, ys)
+
+
+class Ring:
+    """ A ring or line as coordinate arrays, with its cumulative lengths
+    computed on first use. """
+
+    def __init__(self, xs, ys, closed):
+        self.xs = xs
+        self.ys = ys
+        self.closed = closed
+        self._lengths = None
+
+    def __len__(self):
+        return len(self.xs)
+
+    def lengths(self):
+        if self._lengths is None:
+            self._lengths = cumulativeLengths(self.xs, self.ys)
+        return self._lengths
+
+    def routes(self, first, second, byLength=False):
+        lengths = None
+        if byLength:
+            lengths = self.lengths()
+        return ringRoutes(len(self.xs), first, second, self.closed, lengths)
+
+    def route(self, first, second, byLength=False, longest=False):
+        shorter, longer = self.routes(first, second, byLength)
+        if longest:
+            return longer
+        return shorter
+
+    def coordinates(self, runs):
+        """ Return the (x, y) tuples along a route. """
+        return list(zip(sliceRoute(self.xs, runs), sliceRoute(self.ys, runs)))
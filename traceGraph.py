@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+    Tracing graph spanning the boundaries of many features.
+
+    Every vertex of every ring (or line part) becomes a node; vertices that
+    coincide (within the tolerance) share a node, which is what joins
+    adjacent features together. Consecutive vertices are joined by edges
+    weighted by their length. A shortest path between two nodes is then a
+    trace that may run along any number of features.
+
+    Rings are added on behalf of an owner (e.g. a feature) and can be
+    removed again by owner, touching only that owner's nodes and edges, so
+    the graph can follow edits. Nodes and edges are reference counted as
+    neighbouring features share them. The ids of removed nodes are reused
+    for new ones so the node lists do not grow while edits come and go.
+"""
+
+from heapq import heappush, heappop
+from math import hypot
+
+
+class TraceGraph:
+
+    def __init__(self, tolerance=0.0):
+        self.tolerance = tolerance
+        self.nodeIds = {}   # node key -> node id
+        self.xs = []
+        self.ys = []
+        self.edges = []     # node id -> {neighbour node id: length}
+        self.nodeRefs = []  # node id -> number of owner vertices at the node
+        self.edgeRefs = {}  # (lower node id, higher node id) -> number of owners of the edge
+        self.owners = {}    # owner -> ([node ids], [edges])
+        self.freeNodes = []
+
+    def nodeKey(self, x, y):
+        if self.tolerance > 0:
+            return (int(round(x / self.tolerance)), int(round(y / self.tolerance)))
+        return (x, y)
+
+    def nodeAt(self, x, y):
+        """ Return the id of the node at (x, y) or None. """
+        return self.nodeIds.get(self.nodeKey(x, y))
+
+    def addNode(self, x, y):
+        key = self.nodeKey(x, y)
+        nodeId = self.nodeIds.get(key)
+        if nodeId is None:
+            if self.freeNodes:
+                nodeId = self.freeNodes.pop()
+                self.xs[nodeId] = x
+                self.ys[nodeId] = y
+            else:
+                nodeId = len(self.xs)
+                self.xs.append(x)
+                self.ys.append(y)
+                self.edges.append({})
+                self.nodeRefs.append(0)
+            self.nodeIds[key] = nodeId
+        self.nodeRefs[nodeId] += 1
+        return nodeId
+
+    def addEdge(self, a, b):
+        """ Add an edge between two nodes, returning its key or None if
+        a and b are the same node. """
+        if a == b:
+            return None
+        edge = (min(a, b), max(a, b))
+        refs = self.edgeRefs.get(edge, 0)
+        if refs == 0:
+            length = hypot(self.xs[b] - self.xs[a], self.ys[b] - self.ys[a])
+            self.edges[a][b] = length
+            self.edges[b][a] = length
+        # Overlapping boundaries of neighbouring features give the same edge twice
+        self.edgeRefs[edge] = refs + 1
+        return edge
+
+    def addRing(self, coords, owner=None):
+        """ Add a ring or line as a chain of edges. coords is a sequence of
+        (x, y) tuples. """
+        nodes, edges = self.owners.setdefault(owner, ([], []))
+        lastNode = None
+        for x, y in coords:
+            node = self.addNode(x, y)
+            nodes.append(node)
+            if lastNode is not None:
+                edge = self.addEdge(lastNode, node)
+                if edge is not None:
+                    edges.append(edge)
+            lastNode = node
+
+    def removeOwner(self, owner):
+        """ Remove everything added on behalf of owner. """
+        nodes, edges = self.owners.pop(owner, ((), ()))
+        for edge in edges:
+            refs = self.edgeRefs[edge] - 1
+            if refs == 0:
+                del self.edgeRefs[edge]
+                a, b = edge
+                del self.edges[a][b]
+                del self.edges[b][a]
+            else:
+                self.edgeRefs[edge] = refs
+        for node in nodes:
+            self.nodeRefs[node] -= 1
+            if self.nodeRefs[node] == 0:
+                del self.nodeIds[self.nodeKey(self.xs[node], self.ys[node])]
+                self.freeNodes.append(node)
+
+    def nodeCount(self):
+        return len(self.xs) - len(self.freeNodes)
+
+    def coordinates(self, path):
+        return [(self.xs[n], self.ys[n]) for n in path]
+
+    def shortestPath(self, start, end, maxVisits=None):
+        """
+            A* search from node start to node end using the straight line
+            distance as heuristic. Returns the list of node ids from start
+            to end (inclusive) or None if there is no route (or maxVisits
+            nodes were settled without reaching end).
+        """
+        search = PathSearch(self, start, end)
+        search.run(maxVisits)
+        return search.path
+
+
+class PathSearch:
+    """
+        A* search from node start to node end of a graph that can be run a
+        slice at a time, e.g. to keep a long search from holding up the
+        user interface. The graph must not change while the search is
+        under way.
+    """
+
+    def __init__(self, graph, start, end):
+        self.graph = graph
+        self.start = start
+        self.end = end
+        self.finished = False
+        self.path = None        # the node ids from start to end (inclusive) once found
+        self.visits = 0         # nodes settled so far
+        self.cost = {start: 0.0}
+        self.previous = {}
+        self.settled = set()
+        self.queue = [(hypot(graph.xs[end] - graph.xs[start], graph.ys[end] - graph.ys[start]), start)]
+
+    def run(self, maxVisits=None):
+        """ Settle up to maxVisits more nodes (or with None, as many as it
+        takes). Returns True once the search has finished, with path set
+        if there is a route. """
+        if self.finished:
+            return True
+        start, end = self.start, self.end
+        xs, ys, edges = self.graph.xs, self.graph.ys, self.graph.edges
+        ex, ey = xs[end], ys[end]
+        cost, previous, settled, queue = self.cost, self.previous, self.settled, self.queue
+        stop = None if maxVisits is None else self.visits + maxVisits
+        while queue:
+            if self.visits == stop:
+                return False
+            estimate, node = heappop(queue)
+            if node in settled:
+                continue
+            if node == end:
+                path = [end]
+                while path[-1] != start:
+                    path.append(previous[path[-1]])
+                path.reverse()
+                self.path = path
+                break
+            settled.add(node)
+            self.visits += 1
+            nodeCost = cost[node]
+            for neighbour, length in edges[node].items():
+                if neighbour in settled:
+                    continue
+                newCost = nodeCost + length
+                if newCost < cost.get(neighbour, newCost + 1):
+                    cost[neighbour] = newCost
+                    previous[neighbour] = node
+                    heappush(queue, (newCost + hypot(ex - xs[neighbour], ey - ys[neighbour]), neighbour))
+        self.finished = True
+        # Only the path is needed from now on
+        self.cost = self.previous = self.settled = self.queue = None
+        return True
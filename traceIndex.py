@@ -0,0 +1,792 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+    The precomputed tracing structures for the snappable layers and the
+    thread that builds them.
+
+    A TraceIndex holds a vertex grid per layer (for snapping) and one trace
+    graph over all line and polygon layers (for tracing across features),
+    everything in map coordinates.
+
+    Building it reads every feature in the extent, which on big layers
+    takes long enough to freeze QGIS, so TraceIndexBuilder does it on a
+    worker thread. The thread never touches the layers themselves - it
+    opens its own data provider from each layer's source, which is safe to
+    use from another thread. Layers whose data only lives in the provider
+    of the layer (memory layers) are read up front on the main thread.
+    Uncommitted edits are not seen by the worker and have to be applied to
+    the finished index by the caller.
+
+    Layers read from local files are cached on disk (see indexCache), so
+    later builds read the features in the extent from the cache instead of
+    the provider. Cache files are written by a background pass of their
+    own once the first tiles have been loaded from the provider.
+
+    The index is loaded in square tiles of map space as the canvas extent
+    moves over them. A feature is loaded whole, once, however many tiles
+    it touches, and the graph keys its nodes by coordinates, so routes run
+    across tile borders as if there were none. Tiles that have not been
+    in view for longest are dropped again once the index outgrows its
+    memory budget.
+"""
+
+import json
+import os
+from collections import OrderedDict
+from math import floor, log
+
+from PyQt4.QtCore import *
+from qgis.core import *
+
+from geometryCache import geometryRings, geometryVertices, layerToMapTransform
+from indexCache import LayerCacheWriter, layerCacheKey, layerCachePath, openLayerCache
+from timings import timed
+from traceGraph import TraceGraph
+from vertexIndex import SegmentGrid, VertexGrid
+
+
+class LayerSpec:
+    """ What the builder needs to know about a layer, gathered on the main
+    thread. """
+
+    def __init__(self, layer, mapCrs, tolerance, indexVertices, traceable, indexSegments=False):
+        self.layerId = layer.id()
+        self.providerKey = layer.providerType()
+        self.source = layer.source()
+        self.subsetString = layer.subsetString()
+        self.layerCrs = QgsCoordinateReferenceSystem(layer.crs())
+        self.mapCrs = mapCrs                # None if no transform is needed
+        self.tolerance = tolerance          # snapping tolerance in map units
+        self.indexVertices = indexVertices
+        self.traceable = traceable
+        self.indexSegments = indexSegments
+        self.features = None                # [(fid, map geometry)] if read up front
+        self.cacheDirectory = None          # where to cache the layer on disk, None not to
+
+
+def featureCoordinates(geom):
+    """ Return (xs, ys, ring bounds) of a geometry: its vertices in vertex
+    order and where its rings start and end among them (no rings for
+    points). """
+    rings = geometryRings(geom)
+    if len(rings) == 0:
+        vertices = geometryVertices(geom)
+        return [p.x() for p in vertices], [p.y() for p in vertices], []
+    xs = []
+    ys = []
+    bounds = [0]
+    for part, ring, points in rings:
+        xs.extend([p.x() for p in points])
+        ys.extend([p.y() for p in points])
+        bounds.append(len(xs))
+    return xs, ys, bounds
+
+
+# Rough memory use of a vertex in the vertex grids and the trace graph
+BYTES_PER_VERTEX = 250
+
+# Segment grid cells are this many snapping tolerances wide, so long
+# segments do not have to be entered into too many cells
+SEGMENT_CELL_TOLERANCES = 4
+
+
+class TraceIndex:
+
+    def __init__(self, graphTolerance=0.0, tileSize=None):
+        self.grids = {}         # layer id -> (VertexGrid, tolerance)
+        self.segmentGrids = {}  # layer id -> (SegmentGrid, tolerance)
+        self.traceable = set()  # ids of the layers in the graph
+        self.graph = TraceGraph(graphTolerance)
+        self.tileSize = tileSize
+        self.tileFeatures = {}  # loaded tile (column, row) -> set of (layer id, fid)
+        self.featureTiles = {}  # (layer id, fid) -> set of the loaded tiles it touches
+        self.featureSizes = {}  # (layer id, fid) -> number of vertices
+        self.vertexCount = 0
+
+    def addLayer(self, layerId, tolerance, indexVertices, traceable, indexSegments=False):
+        if indexVertices:
+            self.grids[layerId] = (VertexGrid(tolerance), tolerance)
+        if indexSegments:
+            self.segmentGrids[layerId] = (SegmentGrid(tolerance * SEGMENT_CELL_TOLERANCES), tolerance)
+        if traceable:
+            self.traceable.add(layerId)
+
+    def addFeature(self, layerId, featureId, geom):
+        """ Add a feature given its geometry in map coordinates. """
+        xs, ys, ringBounds = featureCoordinates(geom)
+        self.addFeatureCoordinates(layerId, featureId, xs, ys, ringBounds)
+
+    def setTolerance(self, layerId, tolerance):
+        """ Change a layer's snapping tolerance, e.g. a tolerance in pixels
+        after zooming. """
+        if layerId in self.grids:
+            self.grids[layerId] = (self.grids[layerId][0], tolerance)
+        if layerId in self.segmentGrids:
+            self.segmentGrids[layerId] = (self.segmentGrids[layerId][0], tolerance)
+
+    def addFeatureCoordinates(self, layerId, featureId, xs, ys, ringBounds):
+        """ Add a feature given its coordinates, see featureCoordinates().
+        A feature already loaded for another tile is only noted as being
+        in the tiles it touches, one touching no loaded tile is left out. """
+        key = (layerId, featureId)
+        if not self.addFeatureTiles(key, xs, ys) or key in self.featureSizes:
+            return
+        self.featureSizes[key] = len(xs)
+        self.vertexCount += len(xs)
+        if layerId in self.grids:
+            self.grids[layerId][0].addFeature(featureId, [(i, xs[i], ys[i]) for i in range(len(xs))])
+        if layerId in self.segmentGrids:
+            self.segmentGrids[layerId][0].addFeature(featureId, xs, ys, ringBounds)
+        if layerId in self.traceable:
+            for ringNr in range(len(ringBounds) - 1):
+                start, stop = ringBounds[ringNr], ringBounds[ringNr + 1]
+                self.graph.addRing(list(zip(xs[start:stop], ys[start:stop])), (layerId, featureId))
+
+    def removeFeature(self, layerId, featureId):
+        key = (layerId, featureId)
+        self.vertexCount -= self.featureSizes.pop(key, 0)
+        for tile in self.featureTiles.pop(key, ()):
+            features = self.tileFeatures.get(tile)
+            if features is not None:
+                features.discard(key)
+        if layerId in self.grids:
+            self.grids[layerId][0].removeFeature(featureId)
+        if layerId in self.segmentGrids:
+            self.segmentGrids[layerId][0].removeFeature(featureId)
+        if layerId in self.traceable:
+            self.graph.removeOwner(key)
+
+    def tilesCovering(self, xmin, ymin, xmax, ymax):
+        """ Return the tiles (column, row) an extent in map coordinates
+        touches. """
+        size = self.tileSize
+        columns = range(int(floor(xmin / size)), int(floor(xmax / size)) + 1)
+        rows = range(int(floor(ymin / size)), int(floor(ymax / size)) + 1)
+        return [(column, row) for column in columns for row in rows]
+
+    def tileExtent(self, tile):
+        column, row = tile
+        size = self.tileSize
+        return (column * size, row * size, (column + 1) * size, (row + 1) * size)
+
+    def hasTile(self, tile):
+        return tile in self.tileFeatures
+
+    def loadTile(self, tile):
+        """ Mark a tile as loaded, before its features are added. """
+        self.tileFeatures.setdefault(tile, set())
+
+    def evictTile(self, tile):
+        """ Drop a tile and the features that are in no other loaded tile. """
+        for key in self.tileFeatures.pop(tile, ()):
+            tiles = self.featureTiles[key]
+            tiles.discard(tile)
+            if len(tiles) == 0:
+                self.removeFeature(*key)
+
+    def addFeatureTiles(self, key, xs, ys):
+        """ Note which loaded tiles a feature touches, returning False if it
+        touches none. Without tiles everything is in. """
+        if self.tileSize is None:
+            return True
+        if len(xs) == 0:
+            return False
+        xmin, ymin, xmax, ymax = min(xs), min(ys), max(xs), max(ys)
+        size = self.tileSize
+        if ((xmax - xmin) / size + 1) * ((ymax - ymin) / size + 1) > len(self.tileFeatures):
+            # A big feature, quicker to go through the loaded tiles
+            first = (int(floor(xmin / size)), int(floor(ymin / size)))
+            last = (int(floor(xmax / size)), int(floor(ymax / size)))
+            tiles = [tile for tile in self.tileFeatures
+                     if first[0] <= tile[0] <= last[0] and first[1] <= tile[1] <= last[1]]
+        else:
+            tiles = [tile for tile in self.tilesCovering(xmin, ymin, xmax, ymax) if tile in self.tileFeatures]
+        if len(tiles) == 0:
+            return False
+        featureTiles = self.featureTiles.setdefault(key, set())
+        for tile in tiles:
+            featureTiles.add(tile)
+            self.tileFeatures[tile].add(key)
+        return True
+
+    def memoryUse(self):
+        """ Estimated bytes used by the loaded features. """
+        return self.vertexCount * BYTES_PER_VERTEX
+
+    def updateFeature(self, layerId, featureId, geom):
+        """ Replace (or with geom None, remove) a feature after an edit. Only
+        the feature's own vertices, nodes and edges are touched. """
+        self.removeFeature(layerId, featureId)
+        if geom is not None:
+            self.addFeature(layerId, featureId, geom)
+
+    def removeTemporaryFeatures(self, layerId):
+        """ Forget the features of a layer with temporary (negative) ids,
+        once they have been committed under their new ids. """
+        featureIds = set()
+        if layerId in self.grids:
+            featureIds.update(fid for fid in self.grids[layerId][0].featureCells if fid < 0)
+        if layerId in self.segmentGrids:
+            featureIds.update(fid for fid in self.segmentGrids[layerId][0].featureCells if fid < 0)
+        if layerId in self.traceable:
+            featureIds.update(fid for owner, fid in self.graph.owners if owner == layerId and fid < 0)
+        for fid in featureIds:
+            self.removeFeature(layerId, fid)
+
+    def nearestVertex(self, x, y):
+        """ Return [(distance, layer id, feature id, vertex nr, x, y)] of the
+        nearest vertex of each layer within its tolerance, nearest first. """
+        hits = []
+        for layerId, (grid, tolerance) in self.grids.items():
+            hit = grid.nearest(x, y, tolerance)
+            if hit is not None:
+                distance, vx, vy, featureId, vertexNr = hit
+                hits.append((distance, layerId, featureId, vertexNr, vx, vy))
+        hits.sort(key=lambda hit: hit[0])
+        return hits
+
+    def nearestSegment(self, x, y):
+        """ Return [(distance, layer id, feature id, first vertex nr,
+        fraction, x, y)] of the nearest point on a segment of each layer
+        within its tolerance, nearest first. See SegmentGrid.nearest(). """
+        hits = []
+        for layerId, (grid, tolerance) in self.segmentGrids.items():
+            hit = grid.nearest(x, y, tolerance)
+            if hit is not None:
+                distance, px, py, featureId, vertexNr, fraction = hit
+                hits.append((distance, layerId, featureId, vertexNr, fraction, px, py))
+        hits.sort(key=lambda hit: hit[0])
+        return hits
+
+
+class TraceIndexBuilder(QThread):
+    """
+        Loads tiles of the layers described by layer specs into a
+        TraceIndex on a worker thread. The tiles must have been marked as
+        loaded and nobody else may use the index until the thread has
+        finished.
+
+        Emits progress(int) with a percentage while running. When the
+        thread has finished, index is the index or None if loading was
+        cancelled.
+    """
+
+    def __init__(self, index, specs, tiles):
+        QThread.__init__(self)
+        self.target = index
+        self.specs = specs
+        self.tiles = tiles
+        self.cancelled = False
+        self.index = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    @timed("trace index build")
+    def run(self):
+        index = self.target
+        steps = len(self.specs) * len(self.tiles)
+        for specNr, spec in enumerate(self.specs):
+            # Memory layers were read for all the tiles at once
+            tiles = self.tiles if spec.features is None else [None]
+            for tileNr, tile in enumerate(tiles):
+                mapExtent = None
+                if tile is not None:
+                    mapExtent = index.tileExtent(tile)
+                for featureNr, featureCount, fid, xs, ys, ringBounds in self.layerFeatures(spec, mapExtent):
+                    if self.cancelled:
+                        return
+                    index.addFeatureCoordinates(spec.layerId, fid, xs, ys, ringBounds)
+                    if featureNr % 1000 == 0:
+                        done = specNr * len(self.tiles) + tileNr + float(featureNr) / max(1, featureCount)
+                        self.emit(SIGNAL("progress(int)"), int(100 * done / steps))
+        self.emit(SIGNAL("progress(int)"), 100)
+        self.index = index
+
+    def layerFeatures(self, spec, mapExtent):
+        """ Yield (feature nr, feature count, fid, xs, ys, ring bounds) in
+        map coordinates for the features of a layer in mapExtent, (xmin,
+        ymin, xmax, ymax) in map coordinates, see featureCoordinates(). """
+        if spec.features is not None:
+            for featureNr, (fid, geom) in enumerate(spec.features):
+                xs, ys, ringBounds = featureCoordinates(geom)
+                yield featureNr, len(spec.features), fid, xs, ys, ringBounds
+            return
+
+        provider, transform = openProvider(spec)
+        if provider is None:
+            return
+        featureCount = provider.featureCount()
+
+        cacheKey = specCacheKey(spec, featureCount)
+        if cacheKey is not None:
+            cache = openLayerCache(spec.cacheDirectory, cacheKey)
+            if cache is not None:
+                for featureNr, (fid, xs, ys, ringBounds) in enumerate(cache.features(mapExtent)):
+                    yield featureNr, featureCount, fid, xs, ys, ringBounds
+                cache.close()
+                return
+
+        # No cache (yet), read the extent from the provider
+        extent = QgsRectangle(*mapExtent)
+        if spec.mapCrs is not None:
+            extent = QgsCoordinateTransform(spec.mapCrs, spec.layerCrs).transformBoundingBox(extent)
+        request = QgsFeatureRequest(extent).setSubsetOfAttributes([])
+        for featureNr, (fid, xs, ys, ringBounds) in enumerate(providerFeatures(provider, request, transform)):
+            if self.cancelled:
+                return
+            yield featureNr, featureCount, fid, xs, ys, ringBounds
+
+
+class LayerCacheBuilder(QThread):
+    """
+        Writes cache files for the layers described by layer specs that
+        have none, on a worker thread of its own so that loading tiles
+        never waits for a whole layer to be read.
+
+        Layers are read one feature at a time and spooled to disk. When
+        the thread has finished, failed holds the ids (see cacheKeyId())
+        of the cache files that could not be written.
+    """
+
+    def __init__(self, specs, skipKeys):
+        QThread.__init__(self)
+        self.specs = specs
+        self.skipKeys = skipKeys
+        self.cancelled = False
+        self.failed = []
+
+    def cancel(self):
+        self.cancelled = True
+
+    @timed("trace index cache write")
+    def run(self):
+        for spec in self.specs:
+            provider, transform = openProvider(spec)
+            if provider is None:
+                continue
+            key = specCacheKey(spec, provider.featureCount())
+            if key is None or cacheKeyId(key) in self.skipKeys:
+                continue
+            cache = openLayerCache(spec.cacheDirectory, key)
+            if cache is not None:
+                cache.close()
+                continue
+
+            writer = LayerCacheWriter(layerCachePath(spec.cacheDirectory, key), key)
+            request = QgsFeatureRequest().setSubsetOfAttributes([])
+            for fid, xs, ys, ringBounds in providerFeatures(provider, request, transform):
+                if self.cancelled:
+                    writer.abort()
+                    return
+                if writer.failed:
+                    break
+                writer.addFeature(fid, xs, ys, ringBounds)
+            if not writer.write():
+                self.failed.append(cacheKeyId(key))
+
+
+def openProvider(spec):
+    """ Return a provider of its own for a layer spec (so it can be read
+    on a worker thread) and the transform from the layer to map
+    coordinates, or (None, None) if the layer's source can not be read. """
+    provider = QgsProviderRegistry.instance().provider(spec.providerKey, spec.source)
+    if provider is None or not provider.isValid():
+        return None, None
+    if spec.subsetString:
+        provider.setSubsetString(spec.subsetString)
+    transform = None
+    if spec.mapCrs is not None:
+        transform = QgsCoordinateTransform(spec.layerCrs, spec.mapCrs)
+    return provider, transform
+
+
+def providerFeatures(provider, request, transform):
+    """ Yield (fid, xs, ys, ring bounds) in map coordinates of the features
+    a request returns, see featureCoordinates(). """
+    features = provider.getFeatures(request)
+    f = QgsFeature()
+    while features.nextFeature(f):
+        if f.geometry() is None:
+            continue
+        geom = QgsGeometry(f.geometry())
+        if transform is not None:
+            geom.transform(transform)
+        xs, ys, ringBounds = featureCoordinates(geom)
+        yield f.id(), xs, ys, ringBounds
+
+
+def specCacheKey(spec, featureCount):
+    """ The key of the cache file of a layer spec, None if it is not to
+    be cached. """
+    if spec.cacheDirectory is None:
+        return None
+    coordinateCrs = spec.mapCrs if spec.mapCrs is not None else spec.layerCrs
+    return layerCacheKey(spec.source, spec.subsetString, featureCount, coordinateCrs.toProj4())
+
+
+def cacheKeyId(key):
+    return json.dumps(key, sort_keys=True)
+
+
+class TraceIndexManager(QObject):
+    """
+        Keeps a TraceIndex of the snappable layers in the canvas extent.
+
+        Edits to the snappable layers (including the features we trace
+        into them) are applied to the index as they happen, one feature at
+        a time.
+
+        The tiles covering the extent are loaded in the background when
+        the index is asked for. Panning loads the tiles that came into
+        view, tiles out of view are kept until the index grows past its
+        memory budget (/autoTrace/tileBudgetMb), least recently visible
+        first. Zooming far enough for the tiles to be the wrong size for
+        the view, or a change of layers, snapping settings or map CRS,
+        drops the index. While tiles are loading index() returns None and
+        callers fall back to the QGIS snapper and single feature tracing.
+
+        Emits progress(int) while building and ready() or cancelled() when
+        done.
+    """
+
+    def __init__(self, canvas):
+        QObject.__init__(self)
+        self.canvas = canvas
+        self.graphTolerance = QSettings().value("/autoTrace/graphTolerance", 0.0, type=float)
+        self.tileBudget = QSettings().value("/autoTrace/tileBudgetMb", 512, type=int) * 1024 * 1024
+        self.traceIndex = None
+        self.tileUse = OrderedDict()    # loaded tiles, least recently visible first
+        self.visibleTiles = set()
+        self.extentDirty = False
+        self.builder = None
+        self.retiredBuilders = []
+        self.cacheBuilder = None
+        self.cacheCheckedLayers = set()   # ids of the layers given to a cache builder
+        self.failedCacheKeys = set()      # cache files that could not be written
+        self.cancelled = False
+        self.pendingEdits = set()   # (layer, fid) edited while building
+        self.revision = 0           # changes whenever what the index holds may have
+        self.watchedEdits = []
+
+        self.connections = [(self.canvas, SIGNAL("extentsChanged()"), self.extentChanged)]
+        for sender, signal in [(self.canvas, "layersChanged()"),
+                               (self.canvas.mapRenderer(), "destinationSrsChanged()"),
+                               (self.canvas.mapRenderer(), "hasCrsTransformEnabled(bool)"),
+                               (QgsProject.instance(), "snapSettingsChanged()"),
+                               (QgsMapLayerRegistry.instance(), "layersWillBeRemoved(QStringList)")]:
+            self.connections.append((sender, SIGNAL(signal), self.invalidate))
+        for sender, signal, slot in self.connections:
+            QObject.connect(sender, signal, slot)
+
+    def index(self):
+        """ Return the index if the tiles in view are loaded, otherwise
+        start loading them (unless that is already happening) and return
+        None. """
+        if self.builder is not None or self.cancelled:
+            return None
+        if self.traceIndex is None or self.extentDirty:
+            self.loadVisibleTiles()
+        if self.builder is not None:
+            return None
+        return self.traceIndex
+
+    def extentChanged(self):
+        self.extentDirty = True
+        self.cancelled = False
+
+    def idealTileSize(self, extent):
+        """ A power of two about half the size of the extent, so that a
+        handful of tiles cover the view. """
+        size = max(extent.width(), extent.height()) / 2
+        if size <= 0:
+            return 1.0
+        return 2.0 ** round(log(size, 2))
+
+    def snappableLayers(self):
+        proj = QgsProject.instance()
+        return [layer for layer in self.canvas.layers()
+                if layer.type() == QgsMapLayer.VectorLayer and proj.snapSettingsForLayer(layer.id())[1]]
+
+    def snapToleranceInMapUnits(self, layer, units, tolerance):
+        if units == QgsTolerance.Pixels:
+            return tolerance * self.canvas.mapUnitsPerPixel()
+        transform = layerToMapTransform(self.canvas.mapRenderer(), layer)
+        # (project units only exist in newer versions of QGIS)
+        if units == getattr(QgsTolerance, "ProjectUnits", None) or transform is None:
+            return tolerance
+        # Layer units, measure the tolerance in map units around the centre of the map
+        centre = self.canvas.mapRenderer().mapToLayerCoordinates(layer, self.canvas.extent().center())
+        rect = QgsRectangle(centre.x(), centre.y(), centre.x() + tolerance, centre.y() + tolerance)
+        rect = transform.transformBoundingBox(rect)
+        return max(rect.width(), rect.height())
+
+    def mapGeometry(self, layer, featureId):
+        """ Return the current geometry of a feature in map coordinates, or
+        None if it is gone. """
+        f = QgsFeature()
+        request = QgsFeatureRequest(featureId).setSubsetOfAttributes([])
+        if not layer.getFeatures(request).nextFeature(f) or f.geometry() is None:
+            return None
+        geom = QgsGeometry(f.geometry())
+        transform = layerToMapTransform(self.canvas.mapRenderer(), layer)
+        if transform is not None:
+            geom.transform(transform)
+        return geom
+
+    def layerSpec(self, layer, mapExtent=None):
+        """ Describe a layer for the builder. Memory layers are read here,
+        within mapExtent (a QgsRectangle in map coordinates) if given. """
+        ok, enabled, snapType, units, tolerance, avoidIntersections = QgsProject.instance().snapSettingsForLayer(layer.id())
+        tolerance = self.snapToleranceInMapUnits(layer, units, tolerance)
+        indexVertices = snapType != QgsSnapper.SnapToSegment and tolerance > 0
+        traceable = layer.geometryType() in (QGis.Line, QGis.Polygon)
+        # Traces can start and end part of the way along the segments of lines and polygons
+        indexSegments = snapType != QgsSnapper.SnapToVertex and tolerance > 0 and traceable
+        if not indexVertices and not traceable:
+            return None
+
+        renderer = self.canvas.mapRenderer()
+        mapCrs = None
+        if layerToMapTransform(renderer, layer) is not None:
+            mapCrs = QgsCoordinateReferenceSystem(renderer.destinationCrs())
+        spec = LayerSpec(layer, mapCrs, tolerance, indexVertices, traceable, indexSegments)
+        spec.cacheDirectory = self.cacheDirectory()
+
+        if layer.providerType() == "memory" and mapExtent is not None:
+            # The data only exists in this layer's provider, read it here
+            extent = renderer.mapToLayerCoordinates(layer, mapExtent)
+            request = QgsFeatureRequest(extent).setSubsetOfAttributes([])
+            spec.features = []
+            transform = layerToMapTransform(renderer, layer)
+            f = QgsFeature()
+            features = layer.getFeatures(request)
+            while features.nextFeature(f):
+                if f.geometry() is None:
+                    continue
+                geom = QgsGeometry(f.geometry())
+                if transform is not None:
+                    geom.transform(transform)
+                spec.features.append((f.id(), geom))
+        return spec
+
+    def cacheDirectory(self):
+        """ Where layers are cached on disk: next to the project, or in the
+        QGIS settings directory if the project has not been saved. None if
+        caching is switched off. """
+        if not QSettings().value("/autoTrace/persistentIndexCache", True, type=bool):
+            return None
+        projectFile = QgsProject.instance().fileName()
+        if projectFile:
+            return os.path.join(os.path.dirname(projectFile), ".autotrace")
+        return os.path.join(QgsApplication.qgisSettingsDirPath(), "autotrace")
+
+    def loadVisibleTiles(self):
+        """ Start loading the tiles in view that are not loaded yet. """
+        self.extentDirty = False
+        extent = self.canvas.extent()
+        tileSize = self.idealTileSize(extent)
+        layers = self.snappableLayers()
+        if self.traceIndex is not None and not (tileSize / 4 <= self.traceIndex.tileSize <= tileSize * 4):
+            # Zoomed too far for the tiles loaded so far
+            self.traceIndex = None
+        if self.traceIndex is None:
+            self.traceIndex = TraceIndex(self.graphTolerance, tileSize)
+            self.tileUse = OrderedDict()
+            self.watchEdits(layers)
+        index = self.traceIndex
+
+        visible = index.tilesCovering(extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
+        self.visibleTiles = set(visible)
+        for tile in visible:
+            self.tileUse.pop(tile, None)
+            self.tileUse[tile] = True
+        missing = [tile for tile in visible if not index.hasTile(tile)]
+
+        missingExtent = None
+        if missing:
+            xmin, ymin, xmax, ymax = index.tileExtent(missing[0])
+            missingExtent = QgsRectangle(xmin, ymin, xmax, ymax)
+            for tile in missing[1:]:
+                xmin, ymin, xmax, ymax = index.tileExtent(tile)
+                missingExtent.combineExtentWith(QgsRectangle(xmin, ymin, xmax, ymax))
+        specs = [spec for spec in [self.layerSpec(layer, missingExtent) for layer in layers] if spec is not None]
+        for spec in specs:
+            # Tolerances in pixels change with the scale
+            if spec.layerId in index.grids or spec.layerId in index.segmentGrids or spec.layerId in index.traceable:
+                index.setTolerance(spec.layerId, spec.tolerance)
+            else:
+                index.addLayer(spec.layerId, spec.tolerance, spec.indexVertices, spec.traceable, spec.indexSegments)
+        if not missing:
+            return
+
+        for tile in missing:
+            index.loadTile(tile)
+        builder = TraceIndexBuilder(index, specs, missing)
+        QObject.connect(builder, SIGNAL("progress(int)"), lambda percent, builder=builder: self.buildProgress(builder, percent))
+        QObject.connect(builder, SIGNAL("finished()"), lambda builder=builder: self.buildFinished(builder))
+        self.builder = builder
+        builder.start(QThread.LowPriority)
+
+    def buildProgress(self, builder, percent):
+        if builder is self.builder:
+            self.emit(SIGNAL("progress(int)"), percent)
+
+    def buildFinished(self, builder):
+        if builder in self.retiredBuilders:
+            self.retiredBuilders.remove(builder)
+            return
+        self.builder = None
+        if builder.index is None:
+            return
+
+        # The builder could not see uncommitted edits nor anything edited while it was running
+        edits = self.pendingEdits
+        self.pendingEdits = set()
+        for layer in self.snappableLayers():
+            if layer.isEditable():
+                editBuffer = layer.editBuffer()
+                for fid in set(editBuffer.addedFeatures().keys()) | set(editBuffer.changedGeometries().keys()) | set(editBuffer.deletedFeatureIds()):
+                    edits.add((layer, fid))
+        for layer, fid in edits:
+            self.traceIndex.updateFeature(layer.id(), fid, self.mapGeometry(layer, fid))
+
+        self.evictTiles()
+        self.revision += 1
+        self.startCacheBuild(builder.specs)
+        self.emit(SIGNAL("ready()"))
+
+    def startCacheBuild(self, specs):
+        """ Write the cache files the layers just loaded do not have yet,
+        unless that is already happening. """
+        specs = [spec for spec in specs
+                 if spec.cacheDirectory is not None and spec.features is None and spec.layerId not in self.cacheCheckedLayers]
+        if self.cacheBuilder is not None or len(specs) == 0:
+            return
+        self.cacheCheckedLayers.update(spec.layerId for spec in specs)
+        builder = LayerCacheBuilder(specs, set(self.failedCacheKeys))
+        QObject.connect(builder, SIGNAL("finished()"), lambda builder=builder: self.cacheBuildFinished(builder))
+        self.cacheBuilder = builder
+        builder.start(QThread.LowestPriority)
+
+    def cacheBuildFinished(self, builder):
+        # Not trying again in this session where the cache can not be written
+        self.failedCacheKeys.update(builder.failed)
+        if builder.cancelled:
+            self.cacheCheckedLayers.difference_update(spec.layerId for spec in builder.specs)
+        if builder is self.cacheBuilder:
+            self.cacheBuilder = None
+
+    def evictTiles(self):
+        """ Drop the least recently visible tiles while over budget. """
+        for tile in list(self.tileUse):
+            if self.traceIndex.memoryUse() <= self.tileBudget or tile in self.visibleTiles:
+                break
+            del self.tileUse[tile]
+            self.traceIndex.evictTile(tile)
+
+    def watchEdits(self, layers):
+        self.unwatchEdits()
+        for layer in layers:
+            slots = [(SIGNAL("featureAdded(QgsFeatureId)"), lambda fid, layer=layer: self.featureEdited(layer, fid)),
+                     (SIGNAL("featureDeleted(QgsFeatureId)"), lambda fid, layer=layer: self.featureEdited(layer, fid)),
+                     (SIGNAL("geometryChanged(QgsFeatureId,QgsGeometry&)"), lambda fid, geom, layer=layer: self.featureEdited(layer, fid)),
+                     (SIGNAL("committedFeaturesAdded(QString,QgsFeatureList)"), lambda layerId, features, layer=layer: self.featuresCommitted(layer, features))]
+            for signal, slot in slots:
+                QObject.connect(layer, signal, slot)
+                self.watchedEdits.append((layer, signal, slot))
+
+    def unwatchEdits(self):
+        for layer, signal, slot in self.watchedEdits:
+            QObject.disconnect(layer, signal, slot)
+        self.watchedEdits = []
+
+    def featureEdited(self, layer, featureId):
+        self.revision += 1
+        if self.builder is not None:
+            self.pendingEdits.add((layer, featureId))
+        elif self.traceIndex is not None:
+            self.traceIndex.updateFeature(layer.id(), featureId, self.mapGeometry(layer, featureId))
+
+    def featuresCommitted(self, layer, features):
+        """ Added features get their real ids when committed. """
+        self.revision += 1
+        if self.builder is not None:
+            # The builder may have read the layer before or after the commit
+            self.invalidate()
+        elif self.traceIndex is not None:
+            self.traceIndex.removeTemporaryFeatures(layer.id())
+            transform = layerToMapTransform(self.canvas.mapRenderer(), layer)
+            for f in features:
+                if f.geometry() is None:
+                    continue
+                geom = QgsGeometry(f.geometry())
+                if transform is not None:
+                    geom.transform(transform)
+                self.traceIndex.updateFeature(layer.id(), f.id(), geom)
+
+    def cancel(self):
+        """ Stop loading tiles. The partly loaded index is dropped and
+        nothing more is loaded until the extent changes, the index is
+        invalidated or resume() is called. """
+        if self.builder is not None:
+            self.builder.cancel()
+            self.retiredBuilders.append(self.builder)
+            self.builder = None
+            self.pendingEdits = set()
+            self.traceIndex = None
+            self.tileUse = OrderedDict()
+            self.cancelled = True
+            self.emit(SIGNAL("cancelled()"))
+
+    def resume(self):
+        self.cancelled = False
+
+    def shutdown(self):
+        """ Stop the worker threads and wait for them to finish, and
+        disconnect from the canvas and the layers, before the plugin goes
+        away. """
+        self.cancel()
+        if self.cacheBuilder is not None:
+            self.cacheBuilder.cancel()
+        for builder in self.retiredBuilders + [self.cacheBuilder]:
+            if builder is not None:
+                builder.wait()
+        self.unwatchEdits()
+        for sender, signal, slot in self.connections:
+            QObject.disconnect(sender, signal, slot)
+        self.connections = []
+
+    def invalidate(self, *args):
+        self.revision += 1
+        self.cancel()
+        self.cancelled = False
+        self.traceIndex = None
+        self.tileUse = OrderedDict()
+        self.cacheCheckedLayers = set()
+        self.unwatchEdits()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+    A trace being digitised, kept compact.
+
+    Each click is a step of the trace: the clicked (or snapped) point plus
+    the segment auto-traced on the way there, if any. A segment along a
+    single ring is just the ring and the route along it (runs of vertex
+    numbers, see traceCore), sharing the ring's coordinate arrays; a
+    route across features is kept as coordinate arrays. The vertices are
+    only expanded when the trace is finished, and undoing a step drops the
+    whole segment at once.
+
+    What a step snapped to is whatever the tool hands in; it is only kept
+    so the tool can restore its snapping state when the step is undone.
+"""
+
+from array import array
+
+from traceCore import routeVertexCount, sliceRoute
+
+
+class RingSegment:
+    """ The vertices of a traceCore.Ring along a route. """
+
+    def __init__(self, ring, runs):
+        self.ring = ring
+        self.runs = runs
+
+    def __len__(self):
+        return routeVertexCount(self.runs)
+
+    def xs(self):
+        return sliceRoute(self.ring.xs, self.runs)
+
+    def ys(self):
+        return sliceRoute(self.ring.ys, self.runs)
+
+
+class CoordinateSegment:
+    """ Vertices given by their coordinates. """
+
+    def __init__(self, xs, ys):
+        self._xs = array('d', xs)
+        self._ys = array('d', ys)
+
+    def __len__(self):
+        return len(self._xs)
+
+    def xs(self):
+        return self._xs
+
+    def ys(self):
+        return self._ys
+
+
+class TraceStep:
+
+    def __init__(self, x, y, snap=None, segment=None):
+        self.x = x
+        self.y = y
+        self.snap = snap        # what the point snapped to, None if nothing
+        self.segment = segment  # the vertices traced before the point, None if none
+        self.drawn = 0          # for the caller: number of vertices drawn for the step
+
+
+class Trace:
+
+    def __init__(self):
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def append(self, x, y, snap=None, segment=None):
+        step = TraceStep(x, y, snap, segment)
+        self.steps.append(step)
+        return step
+
+    def pop(self):
+        """ Remove and return the last step. """
+        return self.steps.pop()
+
+    def last(self):
+        """ Return the last step or None. """
+        if len(self.steps) == 0:
+            return None
+        return self.steps[-1]
+
+    def coordinates(self):
+        """ Return the x and y coordinates of every vertex of the trace as
+        arrays. """
+        xs = array('d')
+        ys = array('d')
+        for step in self.steps:
+            if step.segment is not None:
+                xs.extend(step.segment.xs())
+                ys.extend(step.segment.ys())
+            xs.append(step.x)
+            ys.append(step.y)
+        return xs, ys
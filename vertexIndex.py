@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+# AutoTrace - An editing tool for QGIS that allows users to 'trace' new
+# feature geometry based on existing features.
+# Copyright (C) 2012 Peter Wells for Lutra Consulting
+
+# peter dot wells at lutraconsulting dot co dot uk
+# Lutra Consulting
+# 23 Chestnut Close
+# Burgess Hill
+# West Sussex
+# RH15 8HN
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+    Uniform grids of feature vertices and segments for nearest vertex and
+    nearest segment queries.
+
+    With the cell size set to the snapping tolerance a vertex query only
+    ever looks at the 3x3 block of cells around the cursor, however many
+    vertices there are. Segments are entered into every cell they cross,
+    so a segment query looks at the cells around the cursor in the same
+    way. Features can be added and removed one at a time so the grids can
+    follow edits without being rebuilt. Only occupied cells are stored,
+    so a sparse layer spread over a large extent costs no more than a
+    compact one.
+"""
+
+from math import floor, hypot
+
+
+class VertexGrid:
+
+    def __init__(self, cellSize):
+        self.cellSize = float(cellSize)
+        self.cells = {}         # (column, row) -> [(x, y, feature key, vertex nr), ...]
+        self.featureCells = {}  # feature key -> set of (column, row)
+
+    def cell(self, x, y):
+        return (int(floor(x / self.cellSize)), int(floor(y / self.cellSize)))
+
+    def addFeature(self, key, vertices):
+        """ Add the vertices of a feature. vertices is a sequence of
+        (vertex nr, x, y) tuples. """
+        if key in self.featureCells:
+            self.removeFeature(key)
+        cells = set()
+        for vertexNr, x, y in vertices:
+            c = self.cell(x, y)
+            self.cells.setdefault(c, []).append((x, y, key, vertexNr))
+            cells.add(c)
+        self.featureCells[key] = cells
+
+    def removeFeature(self, key):
+        for c in self.featureCells.pop(key, ()):
+            items = [item for item in self.cells[c] if item[2] != key]
+            if items:
+                self.cells[c] = items
+            else:
+                del self.cells[c]
+
+    def featureCount(self):
+        return len(self.featureCells)
+
+    def nearest(self, x, y, tolerance):
+        """
+            Return (distance, x, y, feature key, vertex nr) of the vertex
+            nearest to (x, y) within tolerance, or None.
+
+            Of vertices at the same distance (e.g. the first and last vertex
+            of a ring) the lowest vertex number of the lowest key wins, like
+            the QGIS snapper.
+        """
+        best = None
+        minColumn, minRow = self.cell(x - tolerance, y - tolerance)
+        maxColumn, maxRow = self.cell(x + tolerance, y + tolerance)
+        for column in range(minColumn, maxColumn + 1):
+            for row in range(minRow, maxRow + 1):
+                for vx, vy, key, vertexNr in self.cells.get((column, row), ()):
+                    distance = hypot(vx - x, vy - y)
+                    if distance > tolerance:
+                        continue
+                    candidate = (distance, key, vertexNr, vx, vy)
+                    if best is None or candidate < best:
+                        best = candidate
+        if best is None:
+            return None
+        distance, key, vertexNr, vx, vy = best
+        return distance, vx, vy, key, vertexNr
+
+
+def projectOntoSegment(x, y, ax, ay, bx, by):
+    """ Return (fraction, px, py) of the point of the segment from (ax, ay)
+    to (bx, by) nearest to (x, y), fraction being 0 at a and 1 at b. """
+    dx = bx - ax
+    dy = by - ay
+    lengthSquared = dx * dx + dy * dy
+    if lengthSquared == 0:
+        return 0.0, ax, ay
+    fraction = ((x - ax) * dx + (y - ay) * dy) / lengthSquared
+    fraction = min(1.0, max(0.0, fraction))
+    return fraction, ax + fraction * dx, ay + fraction * dy
+
+
+class SegmentGrid:
+
+    def __init__(self, cellSize):
+        self.cellSize = float(cellSize)
+        self.cells = {}         # (column, row) -> [(ax, ay, bx, by, feature key, first vertex nr), ...]
+        self.featureCells = {}  # feature key -> set of (column, row)
+
+    def cell(self, x, y):
+        return (int(floor(x / self.cellSize)), int(floor(y / self.cellSize)))
+
+    def segmentCells(self, ax, ay, bx, by):
+        """ Return the cells the segment from (ax, ay) to (bx, by) crosses,
+        column by column. """
+        if bx < ax:
+            ax, ay, bx, by = bx, by, ax, ay
+        size = self.cellSize
+        cells = []
+        for column in range(int(floor(ax / size)), int(floor(bx / size)) + 1):
+            # Where the segment enters and leaves the column
+            if bx == ax:
+                y0, y1 = ay, by
+            else:
+                slope = (by - ay) / (bx - ax)
+                y0 = ay + (max(ax, column * size) - ax) * slope
+                y1 = ay + (min(bx, (column + 1) * size) - ax) * slope
+            for row in range(int(floor(min(y0, y1) / size)), int(floor(max(y0, y1) / size)) + 1):
+                cells.append((column, row))
+        return cells
+
+    def addFeature(self, key, xs, ys, ringBounds):
+        """ Add the segments of a feature's rings (or lines). The vertices
+        of ring i are xs[ringBounds[i]:ringBounds[i+1]] (and the same of
+        ys), numbered by their position in xs. """
+        if key in self.featureCells:
+            self.removeFeature(key)
+        cells = set()
+        for ringNr in range(len(ringBounds) - 1):
+            for vertexNr in range(ringBounds[ringNr], ringBounds[ringNr + 1] - 1):
+                segment = (xs[vertexNr], ys[vertexNr], xs[vertexNr + 1], ys[vertexNr + 1], key, vertexNr)
+                for c in self.segmentCells(*segment[:4]):
+                    self.cells.setdefault(c, []).append(segment)
+                    cells.add(c)
+        self.featureCells[key] = cells
+
+    def removeFeature(self, key):
+        for c in self.featureCells.pop(key, ()):
+            items = [item for item in self.cells[c] if item[4] != key]
+            if items:
+                self.cells[c] = items
+            else:
+                del self.cells[c]
+
+    def featureCount(self):
+        return len(self.featureCells)
+
+    def nearest(self, x, y, tolerance):
+        """
+            Return (distance, x, y, feature key, first vertex nr, fraction)
+            of the point nearest to (x, y) within tolerance on any segment,
+            or None. The point is fraction of the way from the segment's
+            first vertex to the next one.
+        """
+        best = None
+        minColumn, minRow = self.cell(x - tolerance, y - tolerance)
+        maxColumn, maxRow = self.cell(x + tolerance, y + tolerance)
+        for column in range(minColumn, maxColumn + 1):
+            for row in range(minRow, maxRow + 1):
+                for ax, ay, bx, by, key, vertexNr in self.cells.get((column, row), ()):
+                    fraction, px, py = projectOntoSegment(x, y, ax, ay, bx, by)
+                    distance = hypot(px - x, py - y)
+                    if distance > tolerance:
+                        continue
+                    candidate = (distance, key, vertexNr, fraction, px, py)
+                    if best is None or candidate < best:
+                        best = candidate
+        if best is None:
+            return None
+        distance, key, vertexNr, fraction, px, py = best
+        return distance, px, py, key, vertexNr, fraction
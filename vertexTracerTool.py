@@ -47,10 +47,10 @@
         If the last point in the RB is snapped to a feature:
             If we're currently snapping to the same feature:
                 Determine the vertices that make the shortest path between v1 and v2
-                Add them as uncommitted vertices to the rb
+                Show them as uncommitted vertices in the preview rb
         
     If the left button is clicked and the shift key is down:
-        Unmark any vertices marked as preliminary
+        Move the uncommitted vertices from the preview rb to the rb
         
     
     High level
@@ -66,6 +66,30 @@ from PyQt4.QtGui import *
 from qgis.core import *
 from qgis.gui import *
 
+import time
+
+from geometryCache import GeometryCache, layerToMapTransform
+from traceCore import decimate, dropRepeatedVertices, lineStringWkb, polygonWkb, routeVertexCount, skipRoute, sliceRoute
+from traceGraph import PathSearch
+from traceIndex import TraceIndexManager
+from traceSegments import CoordinateSegment, RingSegment, Trace
+from timings import timed
+from vertexIndex import projectOntoSegment
+
+
+class SnapResult:
+    """ The parts of QgsSnappingResult the tracer uses, for vertices and
+    segments found in our own index. Like QgsSnappingResult a point on a
+    segment has vertex nr -1 and the vertices either side of it. """
+
+    def __init__(self, layer, featureId, vertexNr, point, beforeVertexNr=-1, afterVertexNr=-1):
+        self.layer = layer
+        self.snappedAtGeometry = featureId
+        self.snappedVertexNr = vertexNr
+        self.snappedVertex = point
+        self.beforeVertexNr = beforeVertexNr
+        self.afterVertexNr = afterVertexNr
+
 # Vertex Finder Tool class
 class VertexTracerTool(QgsMapTool):
     
@@ -80,16 +104,72 @@ class VertexTracerTool(QgsMapTool):
         self.mShift = False
         self.lastPoint = None
         self.pointsProposed = False
-        self.propVertCnt = 0
+        # The proposed route in full resolution, the preview only shows what can be seen of it
+        self.proposedXs = []
+        self.proposedYs = []
+        # The proposed route as a segment of the trace
+        self.proposedSegment = None
+        # Route numbers of the proposed vertices drawn in the preview
+        self.previewSources = []
+        # (ring, first vertex, direction, pixel size) of a proposal along a ring
+        self.proposalWalk = None
         self.snappedLayer = None
         self.snappedGeometry = None
         self.snappedVertexNr = None
+        # How far along the segment from snappedVertexNr the snapped point is
+        self.snappedFraction = 0.0
         self.snappedPartNr = None
         self.snappedRingNr = None
         self.snappedRingVertexOffset = None
         self.snappedToPolygon = False
+        self.geometryCache = GeometryCache(self.layerToMapTransform)
+        # Snapping results by screen position, for the canvas state they were found in
+        self.snapCache = {}
+        self.snapCacheState = None
+        # ((ring, first vertex, second vertex, by length), (shorter, longer)) of the last route
+        self.routeCache = None
+
+        # Vertex grids and the trace graph of the snappable layers in the current extent, built
+        # in the background. The vertex grids are used instead of the QGIS snapper (which
+        # queries every layer on every call) once they are ready
+        self.useVertexIndex = QSettings().value("/autoTrace/useVertexIndex", True, type=bool)
+        self.traceIndexManager = TraceIndexManager(self.canvas)
+
+        # Cached geometries are held in map coordinates
+        QObject.connect(self.canvas.mapRenderer(), SIGNAL("destinationSrsChanged()"), self.mapCrsChanged)
+        QObject.connect(self.canvas.mapRenderer(), SIGNAL("hasCrsTransformEnabled(bool)"), self.mapCrsChanged)
 
+        # Routes across features are searched for graphVisitsPerSlice nodes at a time, so a long
+        # search does not hold up the canvas; it carries on between mouse moves until the route
+        # is found or graphMaxVisits nodes have been visited. The last search is kept, with its
+        # result once it has finished, by (graph, index revision, start node, end node)
+        self.graphMaxVisits = QSettings().value("/autoTrace/graphMaxVisits", 200000, type=int)
+        self.graphVisitsPerSlice = QSettings().value("/autoTrace/graphVisitsPerSlice", 2000, type=int)
+        self.graphSearch = None
+        self.graphSearchTimer = QTimer()
+        self.graphSearchTimer.setSingleShot(True)
+        QObject.connect(self.graphSearchTimer, SIGNAL("timeout()"), self.continueGraphSearch)
+        self.routeByLength = QSettings().value("/autoTrace/routeByLength", False, type=bool)
+
+        # Mouse moves are coalesced: only the newest position is processed, once the event
+        # queue is empty and no more often than maxRefreshRate times a second
+        self.maxRefreshRate = QSettings().value("/autoTrace/maxRefreshRate", 60, type=int)
+        self.pendingMovePos = None
+        self.lastMoveTime = 0.0
+        self.moveTimer = QTimer()
+        self.moveTimer.setSingleShot(True)
+        QObject.connect(self.moveTimer, SIGNAL("timeout()"), self.processPendingMove)
+
+        # The committed vertices (plus the one following the mouse) and the proposed ones live
+        # in separate bands so the proposal can be replaced in one go
         self.rb = QgsRubberBand(self.canvas, QGis.Line)
+        self.previewRb = QgsRubberBand(self.canvas, QGis.Line)
+
+        # The trace itself, the rb only shows it at screen resolution
+        self.trace = Trace()
+        self.traceGeometryType = QGis.Line
+        self.traceResolution = None
+        QObject.connect(self.canvas, SIGNAL("extentsChanged()"), self.canvasExtentsChanged)
 
         self.autoCursor = QCursor(QPixmap(["16 16 3 1",
                                           "      c None",
@@ -121,15 +201,18 @@ class VertexTracerTool(QgsMapTool):
         rb_b = s.value("/qgis/digitizing/line_color_blue", 0, type=int)
         rb_a = s.value("/qgis/digitizing/line_color_alpha", 200, type=int)
 
-        self.rb.setColor(QColor(rb_r, rb_g, rb_b, rb_a))
-        self.rb.setWidth(rb_w)
+        for rb in (self.rb, self.previewRb):
+            rb.setColor(QColor(rb_r, rb_g, rb_b, rb_a))
+            rb.setWidth(rb_w)
 
-    def proposeRBUpdate(self, event=None):
+    @timed("proposeRBUpdate")
+    def proposeRBUpdate(self, pos=None):
         """
-          Pop the last vert off the rb (the current mouse position)
-          Push our proposed ones on
-          Make not of how many proposed verts were added (propVertCnt)
-          Push back the last vert
+          Move the last vert of the rb (the current mouse position)
+          Show our proposed ones in the preview rb
+          
+          pos is the cursor position on screen, the last known mouse
+          position is used if it is not given.
         """
         if self.started:
           
@@ -137,160 +220,324 @@ class VertexTracerTool(QgsMapTool):
             # i.e. the cursor doesn't follow the mouse
             
             if self.snappedLayer is None:
+                self.revertProposedRBUpdate()
                 return
             
             newMouseP = None
             retval = 0
             snapResults = []
-            if event is not None:
-                x = event.pos().x()
-                y = event.pos().y()
+            if pos is not None:
+                x = pos.x()
+                y = pos.y()
                 newMouseP =  QgsMapToPixel.toMapCoordinates(self.canvas.getCoordinateTransform (), x, y)
                 eventPoint = QPoint(x,y)
-                (retval,snapResults) = self.snapper.snapToBackgroundLayers(eventPoint)
+                (retval,snapResults) = self.snapToBackgroundLayers(eventPoint)
             else:
                 x = self.canvas.mouseLastXY().x()
                 y = self.canvas.mouseLastXY().y()
                 vertCount = self.rb.numberOfVertices()
                 #newMouseP = QgsPoint( self.rb.getPoint( 0, vertCount - 1 ) )
                 
-                (retval,snapResults) = self.snapper.snapToBackgroundLayers( QPoint(x,y) )
+                (retval,snapResults) = self.snapToBackgroundLayers( QPoint(x,y) )
               
             if len(snapResults) < 1:
                 # There was nothing to snap to here, just update the end of the rb
                 self.clearSnapIndicator()
+                self.revertProposedRBUpdate()
                 point = QgsMapToPixel.toMapCoordinates(self.canvas.getCoordinateTransform (), x, y)
                 self.rb.movePoint(point)
                 return
             else:
                 self.updateSnapIndicator(snapResults[0].snappedVertex)
-                part, ring = self.getPartAndRing(snapResults[0].layer, snapResults[0].snappedAtGeometry, snapResults[0].snappedVertexNr)
+                vertexNr, fraction = self.snapLocation(snapResults[0])
+                part, ring = self.getPartAndRing(snapResults[0].layer, snapResults[0].snappedAtGeometry, vertexNr)
                 if snapResults[0].layer <> self.snappedLayer or \
                     snapResults[0].snappedAtGeometry <> self.snappedGeometry or \
                     self.snappedPartNr != part or \
                     self.snappedRingNr != ring:
-                    # We snapped to something but we can't do anything fancy with it
-                    self.rb.movePoint(snapResults[0].snappedVertex)
+                    # We snapped to something else, see if we can get there along the boundaries
+                    # of the features in between
+                    if not self.proposeGraphRoute(snapResults[0].snappedVertex):
+                        self.revertProposedRBUpdate()
+                        self.rb.movePoint(snapResults[0].snappedVertex)
                     return
                 
             # By this point, we should be snapping to the same layer and geomtry as last time (so we can now 
             # calculate paths between the two points
             
-            self.rb.removeLastPoint()
-            
             # Now determine the points that we need to add
-            newVerts = self.getAdditionalVerts( snapResults[0].snappedVertexNr )
-
-            f = QgsFeature()
-            self.snappedLayer.getFeatures(QgsFeatureRequest(self.snappedGeometry)).nextFeature(f)
+            route = self.getAdditionalVerts( vertexNr + fraction )
 
-            for newVert in newVerts:
-                if self.snappedToPolygon:
-                    v = f.geometry().vertexAt(newVert)
-                else:
-                    v = f.geometry().vertexAt(newVert)
-                v = self.canvas.mapRenderer().layerToMapCoordinates(self.snappedLayer, v)
-                self.rb.addPoint(v,False)
-                self.propVertCnt += 1
-                self.pointsProposed = True
-            self.rb.update()
+            count = routeVertexCount(route)
+            if count == 0:
+                self.showProposal([], [], snapResults[0].snappedVertex)
+                return
+            
+            # The ring is cached in map coordinates, no need to transform anything
+            entry = self.geometryCache.entry(self.snappedLayer, self.snappedGeometry)
+            ring = entry.ring(self.snappedPartNr, self.snappedRingNr)
             
-            self.rb.addPoint(snapResults[0].snappedVertex)
+            # Routes leaving the same vertex in the same direction only differ at their
+            # tails, e.g. while sliding along a boundary. Just redraw what has changed.
+            walk = (ring, self.snappedVertexNr - self.snappedRingVertexOffset + self.snappedFraction, route[0][2], self.canvas.mapUnitsPerPixel())
+            if self.pointsProposed and walk == self.proposalWalk:
+                common = min(count, len(self.proposedXs))
+                tail = skipRoute(route, common)
+                self.changeProposal(common, sliceRoute(ring.xs, tail), sliceRoute(ring.ys, tail), snapResults[0].snappedVertex)
+            else:
+                self.showProposal(sliceRoute(ring.xs, route), sliceRoute(ring.ys, route), snapResults[0].snappedVertex)
+                self.proposalWalk = walk
+            self.proposedSegment = RingSegment(ring, route)
+    
+    @timed("rubber band update")
+    def showProposal(self, xs, ys, endPoint):
+        """
+            Move the end of the rb to endPoint and show the vertices xs, ys
+            (in map coordinates) as the proposed route between the last
+            committed vertex and endPoint.
+            
+            Only vertices that fall into different screen pixels are drawn,
+            all of them are kept for when the proposal is accepted.
+        """
+        self.rb.movePoint(endPoint)
+        if len(xs) == 0:
+            self.revertProposedRBUpdate()
+            return
+        
+        lastCommitted = QgsPoint(self.rb.getPoint(0, self.rb.numberOfVertices()-2))
+        points = [lastCommitted]
+        self.previewSources = decimate(xs, ys, self.canvas.mapUnitsPerPixel())
+        for i in self.previewSources:
+            points.append(QgsPoint(xs[i], ys[i]))
+        points.append(endPoint)
+        self.previewRb.setToGeometry(QgsGeometry.fromPolyline(points), None)
+        self.proposedXs = xs
+        self.proposedYs = ys
+        self.proposalWalk = None
+        self.pointsProposed = True
+    
+    @timed("rubber band update")
+    def changeProposal(self, count, tailXs, tailYs, endPoint):
+        """
+            Cut the proposed route back to its first count vertices (at
+            least one), append the vertices tailXs, tailYs and move its end
+            to endPoint. Only the changed end of the preview is redrawn.
+        """
+        self.rb.movePoint(endPoint)
+        del self.proposedXs[count:]
+        del self.proposedYs[count:]
+        
+        # Drop the old end point and whatever was drawn of the vertices cut off
+        self.previewRb.removePoint(-1, False)
+        while self.previewSources and self.previewSources[-1] >= count:
+            self.previewSources.pop()
+            self.previewRb.removePoint(-1, False)
+        
+        if len(tailXs) > 0:
+            # Carry on filtering from the last vertex we kept, drawn or not
+            xs = self.proposedXs[-1:] + tailXs
+            ys = self.proposedYs[-1:] + tailYs
+            for i in decimate(xs, ys, self.canvas.mapUnitsPerPixel())[1:]:
+                self.previewSources.append(count - 1 + i)
+                self.previewRb.addPoint(QgsPoint(xs[i], ys[i]), False)
+            self.proposedXs.extend(tailXs)
+            self.proposedYs.extend(tailYs)
+        self.previewRb.addPoint(endPoint)
       
+    def proposeGraphRoute(self, endPoint):
+        """
+            Propose the shortest route along the trace graph from the last
+            committed vertex to endPoint (both in map coordinates).
+            
+            Returns False if either point is not on the graph or there is no
+            route between them, or while the route is still being searched
+            for - the search then carries on shortly, see
+            continueGraphSearch().
+        """
+        if self.lastPoint is None or not QSettings().value("/autoTrace/traceAcrossFeatures", True, type=bool):
+            return False
+        
+        index = self.traceIndexManager.index()
+        if index is None:
+            # Still being built
+            return False
+        graph = index.graph
+        start = graph.nodeAt(self.lastPoint.x(), self.lastPoint.y())
+        end = graph.nodeAt(endPoint.x(), endPoint.y())
+        if start is None or end is None:
+            return False
+        key = (graph, self.traceIndexManager.revision, start, end)
+        if self.graphSearch is None or self.graphSearch[0] != key:
+            self.graphSearch = (key, PathSearch(graph, start, end))
+        search = self.graphSearch[1]
+        if not search.run(min(self.graphVisitsPerSlice, self.graphMaxVisits - search.visits)):
+            if search.visits < self.graphMaxVisits:
+                self.graphSearchTimer.start(0)
+            return False
+        path = search.path
+        if path is None:
+            return False
+        
+        inner = path[1:-1]
+        xs = [graph.xs[n] for n in inner]
+        ys = [graph.ys[n] for n in inner]
+        self.showProposal(xs, ys, endPoint)
+        if self.pointsProposed:
+            self.proposedSegment = CoordinateSegment(xs, ys)
+        return True
+    
+    def continueGraphSearch(self):
+        """ Run the next slice of an unfinished route search by updating the
+        proposal, unless a mouse move is about to do so anyway. """
+        if self.started and self.mShift and not self.moveTimer.isActive():
+            self.proposeRBUpdate()
+    
+    def layerToMapTransform(self, layer):
+        """ Return the transform from layer to map coordinates or None if
+        they are the same. """
+        return layerToMapTransform(self.canvas.mapRenderer(), layer)
+    
+    def mapCrsChanged(self):
+        self.geometryCache.clear()
+    
+    @timed("snapping")
+    def snapToBackgroundLayers(self, pos):
+        """
+            Snap the screen position pos to the nearest vertex of the
+            snappable layers. Returns (0, [snapping results]) like
+            QgsMapCanvasSnapper.snapToBackgroundLayers(), which is used
+            instead while the vertex index is being built or if it is
+            switched off.
+            
+            Results are remembered by screen position until the extent,
+            scale, layers or snappable features change, so snapping again
+            where the cursor already is (e.g. when a modifier key is
+            pressed) is free.
+        """
+        index = None
+        if self.useVertexIndex:
+            index = self.traceIndexManager.index()
+        
+        extent = self.canvas.extent()
+        state = (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum(),
+                 self.canvas.mapUnitsPerPixel(), tuple(layer.id() for layer in self.canvas.layers()),
+                 index is None, self.traceIndexManager.revision)
+        if state != self.snapCacheState:
+            self.snapCache = {}
+            self.snapCacheState = state
+        key = (pos.x(), pos.y())
+        if key in self.snapCache:
+            return self.snapCache[key]
+        
+        if index is None:
+            snapped = self.snapper.snapToBackgroundLayers(pos)
+        else:
+            point = QgsMapToPixel.toMapCoordinates(self.canvas.getCoordinateTransform(), pos.x(), pos.y())
+            results = []
+            for distance, layerId, featureId, vertexNr, x, y in index.nearestVertex(point.x(), point.y()):
+                layer = QgsMapLayerRegistry.instance().mapLayer(layerId)
+                results.append(SnapResult(layer, featureId, vertexNr, QgsPoint(x, y)))
+            if len(results) == 0:
+                # No vertex close enough, try the segments in between
+                for distance, layerId, featureId, vertexNr, fraction, x, y in index.nearestSegment(point.x(), point.y()):
+                    layer = QgsMapLayerRegistry.instance().mapLayer(layerId)
+                    results.append(SnapResult(layer, featureId, -1, QgsPoint(x, y), vertexNr, vertexNr + 1))
+            snapped = (0, results)
+        if len(self.snapCache) >= 256:
+            self.snapCache = {}
+        self.snapCache[key] = snapped
+        return snapped
+    
+    def snapLocation(self, result):
+        """
+            Return (vertex nr, fraction) of a snapping result: the vertex
+            snapped to and 0, or for a point on a segment the vertex the
+            segment starts at and how far along the segment the point is.
+        """
+        if result.snappedVertexNr >= 0 or result.beforeVertexNr < 0:
+            return result.snappedVertexNr, 0.0
+        vertexNr = result.beforeVertexNr
+        entry = self.geometryCache.entry(result.layer, result.snappedAtGeometry)
+        location = None
+        if entry is not None:
+            location = entry.ringIndex().lookup(vertexNr)
+        if location is None:
+            return vertexNr, 0.0
+        part, ringNr, offset, count = location
+        i = vertexNr - offset
+        if i + 1 >= count:
+            return vertexNr, 0.0
+        ring = entry.ring(part, ringNr)
+        point = result.snappedVertex
+        fraction, x, y = projectOntoSegment(point.x(), point.y(), ring.xs[i], ring.ys[i], ring.xs[i+1], ring.ys[i+1])
+        return vertexNr, fraction
+    
     def getAdditionalVerts( self, secondVertexNr ):
         """
             For a given geometry (even multi-part polygons) determien the 
             shortest (or longest) route between:
               
-                self.snappedVertexNr
+                self.snappedVertexNr (plus self.snappedFraction)
                 and
                 secondVertexNr
                 on
                 self.snappedGeometry
                 
-                Are they both the same vertice?
-                    Are they really the same vertice (0 and 4 in a square)
+            Either end may be part of the way along a segment, a vertex
+            number plus the fraction of the way to the next vertex.
+                
+            The route is returned as runs of vertex numbers within the ring,
+            see traceCore.ringRoutes(). Both ways round are worked out
+            together and kept, so holding Ctrl for the longer one only
+            swaps them.
         """
         
-        firstVertexNr = self.snappedVertexNr
+        entry = self.geometryCache.entry(self.snappedLayer, self.snappedGeometry)
+        if entry is None:
+            return []
         
-        firstVertexNr -= self.snappedRingVertexOffset
-        secondVertexNr -= self.snappedRingVertexOffset
+        # Points (and vertices we can not place) have no rings to route along
+        ringIndex = entry.ringIndex()
+        if ringIndex.lookup(int(secondVertexNr)) is None or (self.snappedPartNr, self.snappedRingNr) not in ringIndex.ringNrs:
+            return []
         
+        firstVertexNr = self.snappedVertexNr - self.snappedRingVertexOffset + self.snappedFraction
+        secondVertexNr -= self.snappedRingVertexOffset
         if firstVertexNr == secondVertexNr:
             return []
         
-        largerNr = max(firstVertexNr,secondVertexNr)
-        smallerNr = min(firstVertexNr,secondVertexNr)
-        
-        f = QgsFeature()
-        self.snappedLayer.getFeatures(QgsFeatureRequest(self.snappedGeometry)).nextFeature(f)
-        
-        if not f.geometry().isMultipart():
-            if f.geometry().type() == QGis.Line:
-                vertCount = len( f.geometry().asPolyline() )
-            else:
-                vertCount = len( f.geometry().asPolygon()[self.snappedRingNr] )
-        else:
-            if f.geometry().type() == QGis.Line:
-                vertCount = len( f.geometry().asMultiPolyline()[self.snappedPartNr] )
-            else:
-                vertCount = len( f.geometry().asMultiPolygon()[self.snappedPartNr][self.snappedRingNr] )
-        
-        if self.snappedToPolygon:
-            if ((firstVertexNr == vertCount-1) and (secondVertexNr == 0)) or ((secondVertexNr == vertCount-1) and (firstVertexNr == 0)):
-                return []
-        
-        if self.snappedToPolygon:
-            # Determine which route is shorter
-            joinFaster = False
-            normalDistance = largerNr - smallerNr
-            joinDistance = (vertCount - largerNr - 1) + smallerNr
-            if joinDistance < normalDistance:
-                joinFaster = True
-            if self.mCtrl:
-                joinFaster = not(joinFaster)
-            
-            if joinFaster:
-                if secondVertexNr > firstVertexNr:
-                    a = range(firstVertexNr-1,-1,-1)
-                    b = range(vertCount-2,secondVertexNr,-1)
-                    a.extend(b)
-                    return [x+self.snappedRingVertexOffset for x in a]
-                else:
-                    a = range(firstVertexNr+1,vertCount,1)
-                    b = range(1,secondVertexNr,1)
-                    a.extend(b)
-                    return [x+self.snappedRingVertexOffset for x in a]
-            
-        # else if jointFaster is not true
-        if secondVertexNr > firstVertexNr:
-            newverts = range(firstVertexNr+1,secondVertexNr,1)
-            return [x+self.snappedRingVertexOffset for x in newverts]
-        else:
-            newverts = range(firstVertexNr-1,secondVertexNr,-1)
-            return [x+self.snappedRingVertexOffset for x in newverts]
+        ring = entry.ring(self.snappedPartNr, self.snappedRingNr)
+        key = (ring, firstVertexNr, secondVertexNr, self.routeByLength)
+        if self.routeCache is None or self.routeCache[0] != key:
+            self.routeCache = (key, ring.routes(firstVertexNr, secondVertexNr, self.routeByLength))
+        shorter, longer = self.routeCache[1]
+        if self.mCtrl:
+            return longer
+        return shorter
     
     
     def acceptProposedRBUpdate(self):
-        self.propVertCnt = 0
-        self.pointsProposed = False
+        """
+            Take the proposed vertices, returned as a segment for the next
+            step of the trace (or None if nothing is proposed)
+        """
+        segment = self.proposedSegment
+        self.revertProposedRBUpdate()
+        return segment
     
       
     def revertProposedRBUpdate(self):
         """
-            Pop the last vert off the rb
-            Pop off and discard propVertCnt vertices
-            Push the last vert back on again
+            Throw away the proposed vertices
         """
         if self.pointsProposed:
-            mouseP = QgsPoint( self.rb.getPoint( 0, self.rb.numberOfVertices()-1 ) )
-            self.rb.removeLastPoint()
-            for i in range(self.propVertCnt):
-                self.rb.removeLastPoint()
-            self.rb.addPoint(mouseP)
-            self.propVertCnt = 0
+            self.previewRb.reset(QGis.Line)
+            self.proposedXs = []
+            self.proposedYs = []
+            self.previewSources = []
+            self.proposalWalk = None
             self.pointsProposed = False
+        self.proposedSegment = None
     
     def keyPressEvent(self,  event):
         if event.key() == Qt.Key_Control:
@@ -316,21 +563,49 @@ class VertexTracerTool(QgsMapTool):
             self.removeLastPoint()
 
     def removeLastPoint(self):
-        if self.rb.numberOfVertices() > 0:
-            self.rb.removeLastPoint()
-        rbVertCount = self.rb.numberOfVertices()
-        if rbVertCount >= 2:
-            lastPoint = self.rb.getPoint(0, rbVertCount-2)
-            lastPointOnScreen = self.canvas.getCoordinateTransform().transform(lastPoint)
-            retval, snapResults = self.snapper.snapToBackgroundLayers(QPoint( lastPointOnScreen.x(), lastPointOnScreen.y()))
-            if len(snapResults) > 0:
-                self.updateDetailsOfLastSnap(snapResults[0])
-            else:
-                self.updateDetailsOfLastSnap()
-        else:
+        """
+            Undo the last click, along with anything auto-traced on the way
+            there. What the previous click snapped to was kept with it, so
+            there is no need to snap again.
+        """
+        if len(self.trace) == 0:
+            return
+        self.revertProposedRBUpdate()
+        step = self.trace.pop()
+        previous = self.trace.last()
+        if previous is None:
+            # Nothing left, the next click starts a new trace
+            self.rb.reset(self.traceGeometryType)
+            self.started = False
+            self.lastPoint = None
+            self.restoreSnapState(None)
+            return
+        
+        # Take off the floating end and what was drawn for the step, then float from the previous point
+        for i in range(step.drawn + 1):
+            self.rb.removePoint(-1, False)
+        self.lastPoint = QgsPoint(previous.x, previous.y)
+        self.rb.addPoint(self.lastPoint)
+        self.restoreSnapState(previous.snap)
+    
+    def snapState(self):
+        """ Return what the last click snapped to, see restoreSnapState(). """
+        if self.snappedLayer is None:
+            return None
+        return (self.snappedLayer, self.snappedGeometry, self.snappedVertexNr, self.snappedFraction,
+                self.snappedPartNr, self.snappedRingNr, self.snappedRingVertexOffset, self.snappedToPolygon)
+    
+    def restoreSnapState(self, state):
+        if state is None:
             self.updateDetailsOfLastSnap()
+            return
+        (self.snappedLayer, self.snappedGeometry, self.snappedVertexNr, self.snappedFraction,
+         self.snappedPartNr, self.snappedRingNr, self.snappedRingVertexOffset, self.snappedToPolygon) = state
 
     def canvasPressEvent(self,event):
+        # Bring the preview up to date with where the mouse is before we accept it
+        self.processPendingMove()
+        
         #on left click, we add a point
         if event.button() == Qt.LeftButton:
             layer = self.canvas.currentLayer()
@@ -339,19 +614,22 @@ class VertexTracerTool(QgsMapTool):
 
             #if it the start of a new trace, set the rubberband up
             if self.started == False:
-                self.rb.reset(layer.geometryType())
+                self.traceGeometryType = layer.geometryType()
+                self.rb.reset(self.traceGeometryType)
+                self.previewRb.reset(QGis.Line)
                 self.setupRubberBand()
+                self.trace = Trace()
                 self.lastPoint = None
             
             self.started = True
-            self.acceptProposedRBUpdate()
+            segment = self.acceptProposedRBUpdate()
             
             if layer <> None:
                 #if self.mCtrl == False:
                 x = event.pos().x()
                 y = event.pos().y()
                 selPoint = QPoint(x,y)
-                (retval,result) = self.snapper.snapToBackgroundLayers(selPoint)
+                (retval,result) = self.snapToBackgroundLayers(selPoint)
                 
                 #the point is either from snapping result
                 if result  <> []:
@@ -363,82 +641,31 @@ class VertexTracerTool(QgsMapTool):
                     point =  QgsMapToPixel.toMapCoordinates(self.canvas.getCoordinateTransform (), x, y)
                     self.updateDetailsOfLastSnap()
                   
-                self.appendPoint(QgsPoint(point))
+                self.appendPoint(QgsPoint(point), segment)
             
     
     def getPartAndRing(self, layer, featureId, snappedVertNr):
       """ Return the index of the part and ring that snappedVertNr exists 
       in.  Lines will always have ring=0. """
       
-      f = QgsFeature()
-      layer.getFeatures(QgsFeatureRequest(featureId)).nextFeature(f)
-      geom = f.geometry()
-      snapGeom = QgsGeometry().fromPoint( geom.vertexAt(snappedVertNr) )
-      
-      if not geom.isMultipart():
-          if geom.type() == QGis.Line:
-              # If it was not snapped to this line, we wouldn't even be here
-              self.snappedRingVertexOffset = 0
-              return 0, 0
-          elif geom.type() == QGis.Polygon:
-              ringId = 0
-              vertOffset = 0
-              for ring in geom.asPolygon():
-                  if ringId > 0:
-                      vertOffset += lastRingLen
-                  ringGeom = QgsGeometry().fromPolyline( ring )
-                  if snapGeom.intersects(ringGeom):
-                      self.snappedRingVertexOffset = vertOffset
-                      return 0, ringId
-                  ringId += 1
-                  lastRingLen = len(ring)
-              self.snappedRingVertexOffset = 0
-              return 0, 0 # We should not get here
-          else:
-              self.snappedRingVertexOffset = 0
-              return 0, 0
+      entry = self.geometryCache.entry(layer, featureId)
+      location = None
+      if entry is not None:
+          location = entry.ringIndex().lookup(snappedVertNr)
+      if location is None:
+          # Not a line or polygon (or the feature has gone)
+          self.snappedRingVertexOffset = 0
+          return 0, 0
       
-      else:
-          # Multipart
-          if geom.type() == QGis.Line:
-              partId = 0
-              vertOffset = 0
-              for part in geom.asMultiPolyline():
-                  if partId > 0:
-                      vertOffset += lastLineLength
-                  lineGeom = QgsGeometry().fromPolyline( part )
-                  if lineGeom.intersects(snapGeom):
-                      self.snappedRingVertexOffset = vertOffset
-                      return partId, 0
-                  partId += 1
-                  lastLineLength = len(part)
-              return 0, 0 # We should not get here
-          elif geom.type() == QGis.Polygon:
-              partId = 0
-              vertOffset = 0
-              for part in geom.asMultiPolygon():
-                  ringId = 0
-                  for ring in part:
-                      if partId > 0 or ringId > 0:
-                          vertOffset += lastRingLen
-                      ringGeom = QgsGeometry().fromPolyline( ring )
-                      if snapGeom.intersects(ringGeom):
-                          self.snappedRingVertexOffset = vertOffset
-                          return partId, ringId
-                      ringId += 1
-                      lastRingLen = len(ring)
-                  partId += 1
-              self.snappedRingVertexOffset = 0
-              return 0, 0 # We should not get here
-          else:
-              self.snappedRingVertexOffset = 0
-              return 0, 0
+      part, ring, vertOffset, vertCount = location
+      self.snappedRingVertexOffset = vertOffset
+      return part, ring
 
     def updateDetailsOfLastSnap(self, snappingResult=None):
         if snappingResult is not None:
             self.snappedLayer = snappingResult.layer
             self.snappedGeometry = snappingResult.snappedAtGeometry
-            self.snappedVertexNr = snappingResult.snappedVertexNr
+            self.snappedVertexNr, self.snappedFraction = self.snapLocation(snappingResult)
             part, ring = self.getPartAndRing(self.snappedLayer, self.snappedGeometry, self.snappedVertexNr)
             self.snappedPartNr = part
             self.snappedRingNr = ring
@@ -450,6 +677,7 @@ class VertexTracerTool(QgsMapTool):
             self.snappedLayer = None
             self.snappedGeometry = None
             self.snappedVertexNr = None
+            self.snappedFraction = 0.0
             self.snappedPartNr = None
             self.snappedRingNr = None
             self.snappedRingVertexOffset = None
@@ -473,19 +701,37 @@ class VertexTracerTool(QgsMapTool):
             self.canvas.scene().removeItem(self.snapIndicator)
             self.snapIndicator = None
        
+    @timed("canvasMoveEvent")
     def canvasMoveEvent(self,event):
         
-        x = event.pos().x()
-        y = event.pos().y()
-        eventPoint = QPoint(x,y)
+        # Just remember where the mouse is, any position still waiting to be processed is stale
+        self.pendingMovePos = QPoint(event.pos())
+        if not self.moveTimer.isActive():
+            delay = 0
+            if self.maxRefreshRate > 0:
+                elapsed = time.time() - self.lastMoveTime
+                delay = max(0, int((1.0 / self.maxRefreshRate - elapsed) * 1000))
+            self.moveTimer.start(delay)
+    
+    @timed("preview update")
+    def processPendingMove(self):
+        if self.pendingMovePos is None:
+            return
+        eventPoint = self.pendingMovePos
+        self.pendingMovePos = None
+        self.moveTimer.stop()
+        self.lastMoveTime = time.time()
+        
+        x = eventPoint.x()
+        y = eventPoint.y()
         
         if self.started:
             if self.mShift and self.snappedLayer is not None:
-                self.revertProposedRBUpdate()
-                self.proposeRBUpdate(event)
+                # The current proposal is updated rather than thrown away
+                self.proposeRBUpdate(eventPoint)
             else:
                 # If there is a snapable point nearby, move the end of the rb to it
-                (retval,result) = self.snapper.snapToBackgroundLayers(eventPoint)
+                (retval,result) = self.snapToBackgroundLayers(eventPoint)
                 if result <> []:
                     self.rb.movePoint(result[0].snappedVertex)
                     self.updateSnapIndicator(result[0].snappedVertex)
@@ -495,13 +741,15 @@ class VertexTracerTool(QgsMapTool):
                     self.clearSnapIndicator()
         # Display the snap indicator even if we have not yet started
         else:
-            (retval,result) = self.snapper.snapToBackgroundLayers(eventPoint)
+            (retval,result) = self.snapToBackgroundLayers(eventPoint)
             if len(result) > 0:
                 self.updateSnapIndicator(result[0].snappedVertex)
             else:
                 self.clearSnapIndicator()
 
     def canvasReleaseEvent(self, event):
+        self.processPendingMove()
+        
         #with right click the digitizing is finished
         if self.mShift:
             # User can only finish digitising when they are not holding down shift
@@ -513,61 +761,125 @@ class VertexTracerTool(QgsMapTool):
             self.started = False
             self.clearSnapIndicator()
 
-    def appendPoint(self, point):
+    def appendPoint(self, point, segment=None):
+        """ Add a step to the trace: the vertices of segment (if any) followed
+        by point. """
         #don't add the point if it is identical to the last point we added
-        if (self.lastPoint <> point) :
-            self.rb.addPoint(point)
-            self.lastPoint = point
+        if segment is None and self.lastPoint == point:
+            return
+        step = self.trace.append(point.x(), point.y(), self.snapState(), segment)
+        self.drawStep(step)
+        self.lastPoint = point
+    
+    @timed("rubber band update")
+    def drawStep(self, step):
+        """ Add a step of the trace to the rb, decimated to screen resolution,
+        keeping the vertex following the mouse at the end. """
+        self.traceResolution = self.canvas.mapUnitsPerPixel()
+        points = []
+        if step.segment is not None:
+            xs = step.segment.xs()
+            ys = step.segment.ys()
+            for i in decimate(xs, ys, self.traceResolution):
+                points.append(QgsPoint(xs[i], ys[i]))
+        points.append(QgsPoint(step.x, step.y))
+        
+        before = self.rb.numberOfVertices()
+        floating = points[-1]
+        if before > 0:
+            floating = QgsPoint(self.rb.getPoint(0, before-1))
+            self.rb.removeLastPoint()
+            before -= 1
+        for p in points:
+            self.rb.addPoint(p, False)
+        self.rb.addPoint(floating)
+        # The rb doubles its first vertex
+        step.drawn = self.rb.numberOfVertices() - 1 - before
+    
+    def canvasExtentsChanged(self):
+        """ Redraw the trace when zooming changed the screen resolution. """
+        if not self.started or len(self.trace) == 0 or self.traceResolution == self.canvas.mapUnitsPerPixel():
+            return
+        floating = QgsPoint(self.rb.getPoint(0, self.rb.numberOfVertices()-1))
+        self.rb.reset(self.traceGeometryType)
+        for step in self.trace.steps:
+            self.drawStep(step)
+        self.rb.movePoint(floating)
       
+    @timed("sendGeometry")
     def sendGeometry(self):
         layer = self.canvas.currentLayer() 
 
-        coords = []
-        #backward compatiblity for a bug in qgsRubberband, that was fixed in 1.7
-        if QGis.QGIS_VERSION_INT >= 10700:
-            #[coords.append(self.rb.getPoint(0, i)) for i in range(self.rb.numberOfVertices())]
-            [ coords.append(self.rb.getPoint(0, i)) for i in range(self.rb.numberOfVertices()-1) ] # PW Fix for duplicate final vertice when adding lines
-        else:
-            [coords.append(self.rb.getPoint(0,i)) for i in range(1,self.rb.numberOfVertices())]
+        ## Expand the trace, the rb only shows it at screen resolution
+        xs, ys = self.trace.coordinates()
 
-        ## On the Fly reprojection.
-        layerEPSG = layer.crs().authid()
-        projectEPSG = self.canvas.mapRenderer().destinationCrs().authid()
-        
-        if layerEPSG != projectEPSG:
-            coords_tmp = coords[:]
-            coords = []
-            for point in coords_tmp:
-                transformedPoint = self.canvas.mapRenderer().mapToLayerCoordinates( layer, point );
-                coords.append(transformedPoint)
-           
-            coords_tmp = coords[:]
-            coords = []
-            lastPt = None
-            for pt in coords_tmp:
-                if (lastPt <> pt) :
-                    coords.append(pt)
-                    lastPt = pt
+        ## Drop repeated vertices
+        xs, ys = dropRepeatedVertices(xs, ys)
            
-        ## Add geometry to feature.
+        ## Add geometry to feature, straight from the coordinate arrays
+        g = None
         if layer.geometryType() == QGis.Polygon:
-            g = QgsGeometry().fromPolygon([coords])
+            if len(xs) >= 3:
+                g = QgsGeometry()
+                g.fromWkb(polygonWkb(xs, ys))
         else:
-            g = QgsGeometry().fromPolyline(coords)
+            if len(xs) >= 2:
+                g = QgsGeometry()
+                g.fromWkb(lineStringWkb(xs, ys))
+        
+        ## On the Fly reprojection, the whole geometry at once
+        if g is not None and self.layerToMapTransform(layer) is not None:
+            g.transform(QgsCoordinateTransform(self.canvas.mapRenderer().destinationCrs(), layer.crs()))
         
         self.emit(SIGNAL("traceFound(PyQt_PyObject)"),g) 
         
         #self.emit(SIGNAL("traceFound(PyQt_PyObject)"),self.rb.asGeometry()) 
         self.rb.reset(layer.geometryType())
+        self.revertProposedRBUpdate()
+        self.trace = Trace()
 
     def activate(self):
         self.canvas.setCursor(self.autoCursor)
+        # Start loading the trace index in the background
+        self.traceIndexManager.resume()
+        self.traceIndexManager.index()
         
     def deactivate(self):
+        self.moveTimer.stop()
+        self.graphSearchTimer.stop()
+        self.graphSearch = None
+        self.pendingMovePos = None
         try:
             self.rb.reset()
+            self.previewRb.reset()
         except AttributeError:
             pass
+        self.proposedXs = []
+        self.proposedYs = []
+        self.previewSources = []
+        self.proposalWalk = None
+        self.proposedSegment = None
+        self.pointsProposed = False
+        self.trace = Trace()
+        self.geometryCache.clear()
+        self.snapCache = {}
+        self.snapCacheState = None
+        self.routeCache = None
+        self.traceIndexManager.cancel()
+
+    def shutdown(self):
+        """ Disconnect from the canvas and the layers, remove what the tool
+        drew and stop the index workers, before the plugin goes away. """
+        self.moveTimer.stop()
+        self.graphSearchTimer.stop()
+        QObject.disconnect(self.canvas.mapRenderer(), SIGNAL("destinationSrsChanged()"), self.mapCrsChanged)
+        QObject.disconnect(self.canvas.mapRenderer(), SIGNAL("hasCrsTransformEnabled(bool)"), self.mapCrsChanged)
+        QObject.disconnect(self.canvas, SIGNAL("extentsChanged()"), self.canvasExtentsChanged)
+        self.clearSnapIndicator()
+        for rb in (self.rb, self.previewRb):
+            self.canvas.scene().removeItem(rb)
+        self.geometryCache.shutdown()
+        self.traceIndexManager.shutdown()
 
     def isZoomTool(self):
         return False